@@ -1,5 +1,6 @@
 from transformation_utilities import *
 import logging
+import argparse
 
 
 """A list of all possible status of the projects. A status which is not covered will return false."""
@@ -27,17 +28,13 @@ IGNORE_LIST = {'rdborgid', 'lastupdate', 'status', 'author_mcssid', 'author_unib
 
 BASE_XML_PATH_ACHIEVEMENTS = './metadata/forschdb_achievement/'
 
-if __name__ == '__main__':
-    logging.basicConfig(filename='achievement_transformation.log', filemode='w', level=logging.WARNING)
+AREA_NAME = 'achievements'
+RECORD_NAME = 'achievement'
 
-    tf = TransformFDBRecord('ach', data_base_path='',
-                            base_xml_path=BASE_XML_PATH_ACHIEVEMENTS,
-                            import_filter={'status': IMPORT_STATUS, 'type': ACHIEVEMENT_TYPES},
-                            ignore_list=IGNORE_LIST,
-                            target_path='achievements/')
 
+def transformation_functions(tf):
     """A transformations function for each field. Fields not defined here are ignored and logged."""
-    TRANSFORMATION_FUNCTIONS_ACHIEVEMENTS = {
+    return {
         'identifier': [tf.transform_to_list, {'edoc_tag': 'mcss_id'}],
         'mcssorgid': [tf.transform_to_list, {'edoc_tag': 'divisions'}],
         # TODO: transform achievement types.
@@ -92,8 +89,28 @@ if __name__ == '__main__':
         'enddate': [tf.transform_to_field, {'edoc_tag': 'date_end'}],
     }
 
-    tf.functions = TRANSFORMATION_FUNCTIONS_ACHIEVEMENTS
-    tf.transform_all('achievements', 'achievement')
+
+def create_transformation():
+    """Returns the transformation of the achievements."""
+    tf = TransformFDBRecord('ach', data_base_path='',
+                            base_xml_path=BASE_XML_PATH_ACHIEVEMENTS,
+                            import_filter={'status': IMPORT_STATUS, 'type': ACHIEVEMENT_TYPES},
+                            ignore_list=IGNORE_LIST,
+                            target_path='achievements/')
+
+    tf.functions = transformation_functions(tf)
+    return tf
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Transform RDB achievements into eprints XML.')
+    add_run_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(filename='achievement_transformation.log', filemode='w', level=logging.WARNING)
+
+    tf = create_transformation()
+    tf.transform_all(AREA_NAME, RECORD_NAME, **run_options(tf, args, 'achievements'))
 
 
 
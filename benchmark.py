@@ -0,0 +1,316 @@
+from transformation_utilities import *
+import projects
+import achievements
+import publications
+
+import argparse
+import platform
+import random
+import resource
+import shutil
+import tempfile
+
+"""Benchmarks transform_all for projects, achievements and publications on synthetic harvests.
+
+Elasticsearch, doi.org and the PMC id converter are replaced by local stand-ins with an optional latency. The
+results are written as JSON, so that runs can be compared."""
+
+OAI_NAMESPACE = 'http://www.openarchives.org/OAI/2.0/'
+FDB_NAMESPACE = 'http://forschdb.unibas.ch/'
+
+"""record_type, area name, record name, base xml path, import filter, ignore list, static fields per pipeline."""
+PIPELINES = {
+    'projects': ('proj', 'projects', 'project', projects.BASE_XML_PATH_PROJECTS,
+                 {'status': projects.IMPORT_STATUS}, projects.IGNORE_LIST, {}, projects.transformation_functions),
+    'achievements': ('ach', 'achievements', 'achievement', achievements.BASE_XML_PATH_ACHIEVEMENTS,
+                     {'status': achievements.IMPORT_STATUS, 'type': achievements.ACHIEVEMENT_TYPES},
+                     achievements.IGNORE_LIST, {}, achievements.transformation_functions),
+    'publications': ('pub', 'eprints', 'eprint', publications.BASE_XML_PATH,
+                     {'status': publications.IMPORT_STATUS, 'type': publications.PUBLICATION_TYPE},
+                     publications.IGNORE_LIST, publications.ADD_STATIC_FIELDS, publications.transformation_functions)
+}
+
+WORDS = ('analysis cell data effect model patient risk study system protein gene climate market law history '
+         'language theory network population treatment response structure function method review').split()
+
+PUBLICATION_SUBTYPES = ['Review', 'Rezension', 'Aufsatz/Beitrag in Sammelband', 'Lexikonartikel', 'Edition',
+                        'Internet publication', 'Originalarbeit']
+
+
+def sentence(rng, words=12):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+
+def html_abstract(rng, paragraphs):
+    """An abstract as it comes from the RDB: html with comments, entities, Word styles and special characters."""
+    parts = list()
+    if rng.random() < 0.2:
+        parts.append('<!-- /* Style Definitions */ table.MsoNormalTable --> Normal 0 21 false false false '
+                     'DE-CH X-NONE X-NONE MicrosoftInternetExplorer4 bidi;}')
+    for _ in range(paragraphs):
+        text = ' '.join(sentence(rng, rng.randint(8, 25)) for _ in range(rng.randint(3, 8)))
+        text = text.replace(' risk ', ' \x93risk\x94 ').replace(' data ', ' data\xad ').replace(' model ', ' <i>model</i> ')
+        parts.append('<p>' + text + '<br >&nbsp;p&lt;0.05 \x96 n=' + str(rng.randint(10, 500)) + '</p>')
+    return '\n'.join(parts)
+
+
+def person(rng, tag, dni):
+    fields = [('dni', str(dni)), ('firstname', rng.choice(['Anna', 'Peter', 'Maria', 'Lukas', 'Sara'])),
+              ('lastname', rng.choice(['Meier', 'Müller', 'Schmid', 'Keller', 'Weber'])),
+              ('email', 'person{}@unibas.ch'.format(dni))]
+    if rng.random() < 0.5:
+        fields.append(('orcid', '0000-0002-{:04d}-{:04d}'.format(dni % 10000, rng.randint(0, 9999))))
+    return tag, [(tag + '_' + name, value) for name, value in fields]
+
+
+def publication_fields(rng, n, organisations, authors, abstract_paragraphs):
+    pub_type = rng.choice(list(publications.PUBLICATION_TYPE))
+    fields = [('identifier', str(n)),
+              ('status', 'Published' if rng.random() < 0.85 else rng.choice(list(publications.IMPORT_STATUS))),
+              ('type', pub_type), ('pubtype_weboffice', rng.choice(PUBLICATION_SUBTYPES)),
+              ('title', sentence(rng, 10) + (' &amp; <i>more</i>' if rng.random() < 0.1 else '')),
+              ('description', html_abstract(rng, abstract_paragraphs)),
+              ('date', str(rng.randint(1990, 2018))), ('pages', 'S. {}-{}'.format(n % 500, n % 500 + 15)),
+              ('journal', 'Journal of ' + rng.choice(WORDS).capitalize()), ('volume', str(rng.randint(1, 90))),
+              ('keywords', ', '.join(rng.sample(WORDS, 4))), ('refereed', 'Peer reviewed'),
+              ('unibasel_publication', 'Yes'), ('issn_isbn', '1234-567X' if n % 2 else '978-3-16-148410-0'),
+              ('url', 'https://example.org/{}'.format(n)), ('lastupdate', '2018-01-01')]
+    if rng.random() < 0.5:
+        fields.append(('month_day', '{:02d}-{:02d}'.format(rng.randint(1, 12), rng.randint(1, 28))))
+    if rng.random() < 0.8:
+        fields.append(('doi', 'doi:10.{}/{}'.format(rng.randint(1000, 9999), n)))
+    if rng.random() < 0.4:
+        fields.append(('pubmedid', str(20000000 + n)))
+    if rng.random() < 0.3:
+        fields.append(('fulltext_url', 'https://example.org/{}.pdf'.format(n)))
+    if rng.random() < 0.2:
+        fields.append(('edition', str(rng.randint(1, 5))))
+    for _ in range(rng.randint(1, 3)):
+        fields.append(('mcssorgid', rng.choice(organisations)))
+    for i in range(rng.randint(1, 2 * authors)):
+        fields.append(person(rng, 'unibasauthor', 1000 + rng.randint(0, 5000)))
+    fields.append(person(rng, 'unibascreator', 1000 + rng.randint(0, 5000)))
+    return fields
+
+
+def project_fields(rng, n, organisations, authors, abstract_paragraphs):
+    fields = [('identifier', str(n)),
+              ('status', 'Published' if rng.random() < 0.8 else rng.choice(list(projects.IMPORT_STATUS))),
+              ('type', rng.choice(['Project: Third-party funded project', 'Project: Project funded by own resources'])),
+              ('title', sentence(rng, 8)), ('description', html_abstract(rng, abstract_paragraphs)),
+              ('startdate', '2015-01-01'), ('enddate', '2019-12-31'), ('coverage', rng.choice(['Active', 'Completed'])),
+              ('keywords', ', '.join(rng.sample(WORDS, 4))), ('url', 'https://example.org/p/{}'.format(n)),
+              ('mcssorgid', rng.choice(organisations)), ('lastupdate', '2018-01-01')]
+    for _ in range(rng.randint(1, 3)):
+        fields.append(('financedby', rng.choice(['SNF', 'EU', 'Novartis', 'Universität Basel'])))
+    for _ in range(rng.randint(0, 2 * authors)):
+        fields.append(('affilatedpublication', str(rng.randint(1, 100000))))
+    fields.append(person(rng, 'principalinvestigator', 1000 + rng.randint(0, 5000)))
+    for _ in range(rng.randint(0, authors)):
+        fields.append(person(rng, 'projectmember', 1000 + rng.randint(0, 5000)))
+    return fields
+
+
+def achievement_fields(rng, n, organisations, authors, abstract_paragraphs):
+    fields = [('identifier', str(n)), ('status', 'Published' if rng.random() < 0.9 else 'Incomplete'),
+              ('type', rng.choice(list(achievements.ACHIEVEMENT_TYPES) + ['Editorial work for journals'])),
+              ('title', sentence(rng, 6)), ('mcssorgid', rng.choice(organisations)), ('startdate', '2017-03-01'),
+              ('institution', 'University of ' + rng.choice(WORDS).capitalize()),
+              ('fundingsorce', rng.choice(['SNF', 'EU'])), ('lastupdate', '2018-01-01')]
+    for _ in range(rng.randint(1, authors)):
+        fields.append(('author_dni', str(1000 + rng.randint(0, 5000))))
+    return fields
+
+
+FIELD_GENERATORS = {'proj': project_fields, 'ach': achievement_fields, 'pub': publication_fields}
+
+
+def add_fields(parent, fields):
+    for tag, value in fields:
+        element = ET.SubElement(parent, '{%s}%s' % (FDB_NAMESPACE, tag))
+        if isinstance(value, list):
+            add_fields(element, value)
+        else:
+            element.text = value
+
+
+def generate_organisations(path, count=300, seed=0):
+    """Writes an organisation csv with a hierarchy of count organisations. Returns their mcssids."""
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write('mcssid,parent_mcssid,name\n')
+        file.write('1,,Universität Basel\n')
+        for mcssid in range(2, count + 1):
+            file.write('{},{},Organisation {}\n'.format(mcssid, rng.randint(1, mcssid - 1), mcssid))
+    return [str(mcssid) for mcssid in range(1, count + 1)]
+
+
+def generate_harvest(directory, record_type, records, records_per_file=100, authors=5, abstract_paragraphs=3,
+                     organisations=('1',), seed=0):
+    """Writes records as OAI-PMH ListRecords responses with records_per_file records each."""
+    ET.register_namespace('', OAI_NAMESPACE)
+    ET.register_namespace('fdb', FDB_NAMESPACE)
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    metadata_tag = '{%s}forschdb_%s' % (FDB_NAMESPACE, {'proj': 'project', 'ach': 'achievement',
+                                                         'pub': 'publication'}[record_type])
+    for number, first in enumerate(range(0, records, records_per_file)):
+        root = ET.Element('{%s}OAI-PMH' % OAI_NAMESPACE)
+        ET.SubElement(root, '{%s}responseDate' % OAI_NAMESPACE).text = '2018-04-23T10:00:00Z'
+        list_records = ET.SubElement(root, '{%s}ListRecords' % OAI_NAMESPACE)
+        for n in range(first + 1, min(first + records_per_file, records) + 1):
+            record = ET.SubElement(list_records, '{%s}record' % OAI_NAMESPACE)
+            header = ET.SubElement(record, '{%s}header' % OAI_NAMESPACE)
+            ET.SubElement(header, '{%s}identifier' % OAI_NAMESPACE).text = 'oai:forschdb:{}'.format(n)
+            metadata = ET.SubElement(ET.SubElement(record, '{%s}metadata' % OAI_NAMESPACE), metadata_tag)
+            add_fields(metadata, FIELD_GENERATORS[record_type](rng, n, list(organisations), authors,
+                                                              abstract_paragraphs))
+        ET.SubElement(list_records, '{%s}resumptionToken' % OAI_NAMESPACE).text = str(number + 1)
+        ET.ElementTree(root).write(os.path.join(directory, '{:05d}.xml'.format(number)), encoding='utf-8',
+                                   xml_declaration=True)
+
+
+class LocalElasticIndex(object):
+    """Answers the terms queries of the transformation from synthetic data instead of elasticsearch."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def scan_index(self, query):
+        time.sleep(self.latency)
+        (field, values), = query['query']['terms'].items()
+        if field == 'mcss_id':
+            return [{'mcss_id': value, 'eprintid': 100000 + value} for value in values if value % 4 != 0]
+        elif field == 'contributors.dni.keyword':
+            return [{'contributors': [{'dni': value, 'name': {'given': 'Given', 'family': 'Family {}'.format(value)},
+                                       'id': 'person{}@unibas.ch'.format(value)}]}
+                    for value in values if value % 3 != 0]
+        elif field == 'dni.keyword':
+            return [{'dni': value, 'email': 'person{}@unibas.ch'.format(value), 'firstname': 'First',
+                     'lastname': 'Last {}'.format(value)} for value in values if value % 5 != 0]
+        return list()
+
+
+class LocalDoiValidator(DoiValidator):
+    """Answers DOI handle requests locally after latency seconds."""
+
+    def __init__(self, logger, cache, latency=0.0, profiler=None):
+        super().__init__(logger, cache, profiler=profiler)
+        self.latency = latency
+
+    def _request(self, doi):
+        time.sleep(self.latency)
+        return 100 if doi.endswith('7') else 1
+
+
+class BenchmarkTransformFDBRecord(TransformFDBRecord):
+    """Uses local stand-ins for all network lookups."""
+
+    def __init__(self, *args, latency=0.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latency = latency
+        self.doi_validator = LocalDoiValidator(self.logger, self.cache, latency, profiler=self.profiler)
+
+    @property
+    def path(self):
+        return self.data_path
+
+    def _elastic(self, index, doc_type, url):
+        return LocalElasticIndex(self.latency)
+
+    def _convert_pmids(self, pmids):
+        time.sleep(self.latency)
+        return [{'pmid': pmid, 'doi': '10.1000/{}'.format(pmid)} if int(pmid) % 2 else
+                {'pmid': pmid, 'status': 'error', 'errmsg': 'invalid article id'} for pmid in pmids]
+
+
+def create_pipeline(name, directory, target_path, cache_path, latency=0.0):
+    """Returns the transformation of a pipeline for its synthetic harvest in directory, see generate_harvest."""
+    record_type, area_name, record_name, base_xml_path, import_filter, ignore_list, static_fields, functions = \
+        PIPELINES[name]
+    os.makedirs(target_path, exist_ok=True)
+    tf = BenchmarkTransformFDBRecord(record_type, data_base_path=os.path.join(directory, name) + '/',
+                                     base_xml_path=base_xml_path, import_filter=import_filter,
+                                     ignore_list=ignore_list, target_path=target_path,
+                                     organisation_file=os.path.join(directory, 'organisation.csv'), latency=latency)
+    tf.cache = ResolverCache(path=cache_path)
+    tf.doi_validator.cache = tf.cache
+    tf.side_outputs = {side_output: SideOutput(os.path.join(directory, '{}-{}.txt'.format(name, side_output)))
+                       for side_output in SIDE_OUTPUTS}
+    tf.functions = functions(tf)
+    tf.static_fields = static_fields
+    return tf
+
+
+def run_pipeline(name, directory, workers=1, latency=0.0, size=1000):
+    """Transforms the synthetic harvest of a pipeline and returns the measurements. Meant to run in a fresh
+    process, so that the peak memory belongs to this pipeline alone."""
+    area_name, record_name = PIPELINES[name][1:3]
+    logging.basicConfig(filename=os.path.join(directory, name + '.log'), filemode='w', level=logging.WARNING)
+    target_path = os.path.join(directory, name + '-output') + '/'
+    tf = create_pipeline(name, directory, target_path, os.path.join(directory, name + '-cache.sqlite'),
+                         latency=latency)
+
+    records = tf.record_count
+    start = time.perf_counter()
+    tf.transform_all(area_name, record_name, size=size, workers=workers,
+                     profile=os.path.join(directory, name + '-profile.txt'))
+    seconds = time.perf_counter() - start
+
+    output_bytes = sum(os.path.getsize(os.path.join(target_path, file)) for file in os.listdir(target_path))
+    return {
+        'records': records,
+        'seconds': seconds,
+        'records_per_second': records / seconds if seconds > 0 else None,
+        'peak_memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'output_bytes': output_bytes,
+        # the stages, field functions, lookups and I/O of all processes, see Profiler.
+        'stages': {stage: {'calls': calls, 'seconds': total, 'p95_ms': tf.profiler.percentile(stage, 95) * 1000}
+                   for stage, (calls, total, _) in tf.profiler.stats.items()}
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the transformation on synthetic harvests.')
+    parser.add_argument('--pipelines', nargs='*', default=list(PIPELINES), choices=list(PIPELINES))
+    parser.add_argument('--records', type=int, default=5000, help='Number of records per pipeline.')
+    parser.add_argument('--records-per-file', type=int, default=500, help='Number of records per harvest file.')
+    parser.add_argument('--authors', type=int, default=5, help='Average number of persons per record.')
+    parser.add_argument('--abstract-paragraphs', type=int, default=3, help='Number of paragraphs per abstract.')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds each lookup of the local stand-ins takes, to simulate the network.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used for the transformation.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--directory', help='Keep the generated harvest and the output in this directory.')
+    parser.add_argument('--output', default='benchmark_results.json', help='File the results are written to.')
+    args = parser.parse_args()
+
+    directory = args.directory if args.directory is not None else tempfile.mkdtemp(prefix='fdb2eprints-benchmark-')
+    os.makedirs(directory, exist_ok=True)
+    if not config.has_section('elastic'):
+        config.read_dict({'elastic': {'edoc_url': '', 'fdb_url': ''}})
+
+    organisations = generate_organisations(os.path.join(directory, 'organisation.csv'), seed=args.seed)
+    results = {
+        'parameters': vars(args),
+        'python': platform.python_version(),
+        'pipelines': dict()
+    }
+    try:
+        for name in args.pipelines:
+            generate_harvest(os.path.join(directory, name), PIPELINES[name][0], args.records,
+                             records_per_file=args.records_per_file, authors=args.authors,
+                             abstract_paragraphs=args.abstract_paragraphs, organisations=organisations,
+                             seed=args.seed)
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(run_pipeline, name, directory, workers=args.workers,
+                                         latency=args.latency).result()
+            results['pipelines'][name] = result
+            print('{:<13} {:>7} records {:>8.2f} s {:>9.1f} records/s {:>8} kB peak'.format(
+                name, result['records'], result['seconds'], result['records_per_second'], result['peak_memory_kb']))
+    finally:
+        if args.directory is None:
+            shutil.rmtree(directory)
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
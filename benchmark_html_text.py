@@ -0,0 +1,69 @@
+from transformation_utilities import *
+import argparse
+import timeit
+
+"""Compares clean_html_text with the previous chain of re.sub calls on the abstracts and titles of a harvest."""
+
+HTML_TEXT_FIELDS = {'description', 'title'}
+
+
+def reference_clean_html_text(text):
+    """The text cleaning as it was done before clean_html_text."""
+    text = html.unescape(text)
+    text = re.sub('<!--.*?-->', '', text)
+    text = re.sub('<br\\ >', ' ', text)
+    text = re.sub('<[^<]+?>', '', text)
+    text = re.sub(u'\\x84', '"', text)
+    text = re.sub(u'\\xAD', '', text)
+    text = re.sub(u'\\x96', '-', text)
+    text = re.sub(u'\\x97', '-', text)
+    text = re.sub(u'\\x93', '"', text)
+    text = re.sub(u'\\x94', '"', text)
+    text = re.sub(u'\\x95', '- ', text)
+    text = re.sub(u'\\x91', "'", text)
+    text = re.sub(u'\\x92', "'", text)
+    text = re.sub(u'\\x0A', '', text)
+    text = re.sub(u'\\u00AC', '', text)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'Normal .*?bidi;\}', '', text)
+    return text.strip()
+
+
+def collect_texts(path):
+    """Collects the text of all abstracts and titles in the harvest files below path."""
+    texts = list()
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            for _, element in ET.iterparse(os.path.join(root, file)):
+                if element.tag.split('}', 1)[-1] in HTML_TEXT_FIELDS and element.text is not None:
+                    texts.append(element.text)
+                element.clear()
+    return texts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the cleaning of html texts on the harvested abstracts.')
+    parser.add_argument('paths', nargs='*',
+                        help='Directories with harvest files, by default those of publications and projects in the '
+                             'data section of the config.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed runs, the best one is reported.')
+    args = parser.parse_args()
+    paths = args.paths
+    if len(paths) == 0:
+        paths = [path for path in (config.get('data', 'pub', fallback=None), config.get('data', 'proj', fallback=None))
+                 if path is not None]
+        if len(paths) == 0:
+            parser.error('no paths given and no data section in default.cfg')
+
+    texts = [text for path in paths for text in collect_texts(path)]
+    differences = [text for text in texts if clean_html_text(text) != reference_clean_html_text(text)]
+    if len(differences) > 0:
+        print('{} texts are cleaned differently, for example: {!r}'.format(len(differences), differences[0]))
+
+    reference = min(timeit.repeat(lambda: [reference_clean_html_text(text) for text in texts],
+                                  number=1, repeat=args.repeat))
+    compiled = min(timeit.repeat(lambda: [clean_html_text(text) for text in texts], number=1, repeat=args.repeat))
+    print('{} texts with {} characters.'.format(len(texts), sum(len(text) for text in texts)))
+    print('re.sub chain:    {:.4f} s'.format(reference))
+    print('clean_html_text: {:.4f} s'.format(compiled))
+    print('speedup:         {:.2f}x'.format(reference / compiled if compiled > 0 else float('inf')))
@@ -0,0 +1,93 @@
+from benchmark import *
+
+import argparse
+import shutil
+import sys
+import tempfile
+
+"""Checks that incremental runs list the records as removed which the import filter rejects now or which were
+deleted in the RDB, after a full harvest as well as after a harvest since the last update.
+
+Runs on the synthetic publications harvest of benchmark.py with the local stand-ins for all lookups."""
+
+REJECTED_TYPE = 'Publication: Thesis (Dissertationen, Habilitationen)'
+
+
+def withdraw(directory, rejected, deleted, keep_others=True):
+    """Rewrites the harvest files in directory: the record rejected gets a type the import filter rejects, the
+    record deleted is marked as deleted in its OAI header. Without keep_others all other records are dropped, as
+    in a harvest since the last update."""
+    ET.register_namespace('', OAI_NAMESPACE)
+    ET.register_namespace('fdb', FDB_NAMESPACE)
+    metadata_path = '{%s}metadata/{%s}forschdb_publication' % (OAI_NAMESPACE, FDB_NAMESPACE)
+    for file_name in sorted(os.listdir(directory)):
+        tree = ET.parse(os.path.join(directory, file_name))
+        list_records = tree.getroot().find('{%s}ListRecords' % OAI_NAMESPACE)
+        for record in list_records.findall('{%s}record' % OAI_NAMESPACE):
+            metadata = record.find(metadata_path)
+            identifier = metadata.find('{%s}identifier' % FDB_NAMESPACE).text
+            if identifier == rejected:
+                metadata.find('{%s}type' % FDB_NAMESPACE).text = REJECTED_TYPE
+            elif identifier == deleted:
+                record.find('{%s}header' % OAI_NAMESPACE).set('status', 'deleted')
+                record.remove(record.find('{%s}metadata' % OAI_NAMESPACE))
+            elif not keep_others:
+                list_records.remove(record)
+        tree.write(os.path.join(directory, file_name), encoding='utf-8', xml_declaration=True)
+
+
+def check(directory, delta, workers=1):
+    """Runs a full incremental run and a second one after withdrawing two records. Returns a list of problems."""
+    name = 'publications'
+    _, area_name, record_name = PIPELINES[name][:3]
+    target_path = os.path.join(directory, name + '-output') + '/'
+    cache_path = os.path.join(directory, name + '-cache.sqlite')
+    generate_harvest(os.path.join(directory, name), 'pub', 200, records_per_file=50,
+                     organisations=generate_organisations(os.path.join(directory, 'organisation.csv')))
+
+    tf = create_pipeline(name, directory, target_path, cache_path)
+    tf.transform_all(area_name, record_name, workers=workers, incremental=True)
+    before = dict(tf.record_state)
+    rejected, deleted = sorted(before, key=int)[:2]
+
+    withdraw(os.path.join(directory, name), rejected, deleted, keep_others=not delta)
+    tf = create_pipeline(name, directory, target_path, cache_path)
+    if delta:
+        checkpoint = tf._start_harvest(delta=True)
+        checkpoint['harvested'] = True
+        tf._save_checkpoint(checkpoint)
+    tf.transform_all(area_name, record_name, workers=workers, incremental=True)
+
+    problems = list()
+    with open(target_path + '{}-removed.txt'.format(tf.record_type), 'r') as file:
+        removed = file.read().split()
+    if removed != sorted([rejected, deleted]):
+        problems.append('removed {}, expected {}'.format(removed, sorted([rejected, deleted])))
+    with open(tf.state_path, 'r') as file:
+        state = json.load(file)
+    if rejected in state or deleted in state:
+        problems.append('the state still contains {}'.format(sorted({rejected, deleted} & set(state))))
+    elif set(state) != set(before) - {rejected, deleted}:
+        problems.append('the state has {} records, expected {}'.format(len(state), len(before) - 2))
+    return problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that incremental runs remove rejected and deleted records.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used for the transformation.')
+    args = parser.parse_args()
+
+    if not config.has_section('elastic'):
+        config.read_dict({'elastic': {'edoc_url': '', 'fdb_url': ''}})
+    # the issues of the synthetic records are expected.
+    logging.disable(logging.CRITICAL)
+    failed = False
+    for delta in (False, True):
+        directory = tempfile.mkdtemp(prefix='fdb2eprints-incremental-')
+        try:
+            problems = check(directory, delta, workers=args.workers)
+        finally:
+            shutil.rmtree(directory)
+        print('{:<6} harvest: {}'.format('delta' if delta else 'full', '; '.join(problems) if problems else 'ok'))
+        failed = failed or len(problems) > 0
+    sys.exit(1 if failed else 0)
@@ -1,5 +1,6 @@
 from transformation_utilities import *
 import logging
+import argparse
 
 """A list of all possible status of the projects. Any status not covered will be assumed as False."""
 IMPORT_STATUS = {
@@ -22,17 +23,13 @@ IGNORE_LIST = {'creator', 'date', 'principalinvestigator_dni', 'principalinvesti
 
 BASE_XML_PATH_PROJECTS = './metadata/forschdb_project/'
 
-if __name__ == '__main__':
-    logging.basicConfig(filename='projects_transformation.log', filemode='w', level=logging.WARNING)
+AREA_NAME = 'projects'
+RECORD_NAME = 'project'
 
-    tf = TransformFDBRecord('proj', data_base_path='',
-                            base_xml_path=BASE_XML_PATH_PROJECTS,
-                            import_filter={'status': IMPORT_STATUS},
-                            ignore_list=IGNORE_LIST,
-                            target_path='projects/')
 
+def transformation_functions(tf):
     """A transformations function for each field. Fields not defined here are ignored and logged."""
-    TRANSFORMATION_FUNCTIONS_PROJECTS = {
+    return {
         'identifier': [tf.transform_to_list, {'edoc_tag': 'mcss_id'}],
         'mcssorgid': [tf.transform_to_list, {'edoc_tag': 'divisions'}],
         'type': [tf.transform_project_type, {'edoc_tag': 'type'}],
@@ -56,6 +53,25 @@ if __name__ == '__main__':
         'cooperation': [tf.transform_to_list, {'edoc_tag': 'cooperation'}]
     }
 
-    tf.functions = TRANSFORMATION_FUNCTIONS_PROJECTS
 
-    tf.transform_all('projects', 'project')
+def create_transformation():
+    """Returns the transformation of the projects."""
+    tf = TransformFDBRecord('proj', data_base_path='',
+                            base_xml_path=BASE_XML_PATH_PROJECTS,
+                            import_filter={'status': IMPORT_STATUS},
+                            ignore_list=IGNORE_LIST,
+                            target_path='projects/')
+
+    tf.functions = transformation_functions(tf)
+    return tf
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Transform RDB projects into eprints XML.')
+    add_run_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(filename='projects_transformation.log', filemode='w', level=logging.WARNING)
+
+    tf = create_transformation()
+    tf.transform_all(AREA_NAME, RECORD_NAME, **run_options(tf, args, 'projects'))
@@ -1,5 +1,6 @@
 from transformation_utilities import *
 import logging
+import argparse
 
 """A list of all possible status of the projects. Any status not covered will be assumed as False."""
 IMPORT_STATUS = {
@@ -47,23 +48,27 @@ IGNORE_LIST = {
                 'pagerange',
                 # fields not used in edoc or defined by edoc.
                 'status', 'date_comment', 'unibascreator_mcssid', 'unibaseditor_mcssid', 'unibasauthor_mcssid',
-                'edoc_url', 'isi_doctype', 'lastupdate', 'startdate', 'full_text_status', 'weifghtfactor',
+                'isi_doctype', 'lastupdate', 'startdate', 'full_text_status', 'weifghtfactor',
                 'series_number', 'volume_number'
                }
 
 BASE_XML_PATH = './metadata/forschdb_publication/'
 
-if __name__ == '__main__':
-    logging.basicConfig(filename='publications_transformation.log', filemode='w', level=logging.WARNING)
+AREA_NAME = 'eprints'
+RECORD_NAME = 'eprint'
 
-    tf = TransformFDBRecord('pub', data_base_path='',
-                            base_xml_path=BASE_XML_PATH,
-                            import_filter={'status': IMPORT_STATUS, 'type': PUBLICATION_TYPE},
-                            ignore_list=IGNORE_LIST,
-                            target_path='publications/')
+"""These fields are added to every publication."""
+ADD_STATIC_FIELDS = {
+    'date_type': 'published',
+    'eprints_status': 'buffer',
+    'has_mcss_id': '1',
+
+}
 
+
+def transformation_functions(tf):
     """A transformations function for each field. Fields not defined here are ignored and logged."""
-    TRANSFORMATION_FUNCTIONS_PROJECTS = {
+    return {
         'title': [tf.transform_publication_title, {'edoc_tag': 'title'}],
         # Note: This function creates the type & note fields as well.
         'pubtype_weboffice': [tf.transform_pubtype_weboffice, {'edoc_tag': '_subtype'}],
@@ -85,6 +90,8 @@ if __name__ == '__main__':
         'note': [tf.transform_to_field, {'edoc_tag': 'suggestions'}],
         'pubmed_entrezdate': [tf.transform_to_field, {'edoc_tag': 'entry_date'}],
         'fulltext_url': [tf.log_fulltext_url, {}],
+        # only indexed for the affiliated publications of projects transformed in the same run.
+        'edoc_url': [tf.index_eprint_id, {}],
 
 
         'series': [tf.transform_to_field, {'edoc_tag': 'series'}],
@@ -124,14 +131,28 @@ if __name__ == '__main__':
         'mcssorgid': [tf.transform_mcssorgid, {'edoc_tag': 'divisions'}],
     }
 
-    ADD_STATIC_FIELDS = {
-        'date_type': 'published',
-        'eprints_status': 'buffer',
-        'has_mcss_id': '1',
 
-    }
+def create_transformation(offline=config.getboolean('cache', 'offline', fallback=False)):
+    """Returns the transformation of the publications."""
+    tf = TransformFDBRecord('pub', data_base_path='',
+                            base_xml_path=BASE_XML_PATH,
+                            import_filter={'status': IMPORT_STATUS, 'type': PUBLICATION_TYPE},
+                            ignore_list=IGNORE_LIST,
+                            target_path='publications/',
+                            offline=offline)
 
-    tf.functions = TRANSFORMATION_FUNCTIONS_PROJECTS
+    tf.functions = transformation_functions(tf)
     tf.static_fields = ADD_STATIC_FIELDS
+    return tf
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Transform RDB publications into eprints XML.')
+    add_run_arguments(parser)
+    parser.add_argument('--offline', action='store_true', help='Only use cached answers to validate DOIs and PubMed ids.')
+    args = parser.parse_args()
+
+    logging.basicConfig(filename='publications_transformation.log', filemode='w', level=logging.WARNING)
 
-    tf.transform_all('eprints', 'eprint')
+    tf = create_transformation(offline=args.offline)
+    tf.transform_all(AREA_NAME, RECORD_NAME, **run_options(tf, args, 'publications'))
@@ -0,0 +1,22 @@
+from transformation_utilities import *
+import logging
+import argparse
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a local snapshot of the edoc and RDB persons indices, which '
+                                                 'the transformations can use instead of Elasticsearch.')
+    parser.add_argument('path', nargs='?', default=config.get('snapshot', 'path', fallback='edoc_snapshot.sqlite'),
+                        help='The snapshot file.')
+    parser.add_argument('--index', default='edoc-vmware', help='The edoc index.')
+    parser.add_argument('--doc-type', default='document', help='The document type of the edoc index.')
+    parser.add_argument('--fdb-index', default='fdb-persons', help='The RDB persons index.')
+    parser.add_argument('--fdb-doc-type', default='publication', help='The document type of the RDB persons index.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    EdocSnapshot.build(args.path,
+                       ElasticIndex(args.index, args.doc_type, url=config['elastic']['edoc_url']),
+                       ElasticIndex(args.fdb_index, args.fdb_doc_type, url=config['elastic']['fdb_url']),
+                       args.index, args.fdb_index)
@@ -0,0 +1,47 @@
+from transformation_utilities import *
+import logging
+import argparse
+import achievements
+import projects
+import publications
+
+"""The record types in the order they are transformed. Publications come first, so that the affiliated publications
+of the projects can be resolved with the publications of the same run."""
+RECORD_TYPES = {
+    'publications': publications,
+    'projects': projects,
+    'achievements': achievements,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Transform RDB publications, projects and achievements into eprints '
+                                                 'XML in a single run.')
+    parser.add_argument('types', nargs='*', metavar='type',
+                        help='The record types to transform ({}), all by default.'.format(', '.join(RECORD_TYPES)))
+    add_run_arguments(parser)
+    parser.add_argument('--offline', action='store_true', help='Only use cached answers to validate DOIs and PubMed ids.')
+    args = parser.parse_args()
+    for name in args.types:
+        if name not in RECORD_TYPES:
+            parser.error('unknown record type: {}'.format(name))
+
+    logging.basicConfig(filename='transformation.log', filemode='w', level=logging.WARNING)
+
+    transformations = dict()
+    for name, module in RECORD_TYPES.items():
+        if len(args.types) > 0 and name not in args.types:
+            continue
+        if name == 'publications':
+            tf = module.create_transformation(offline=args.offline)
+        else:
+            tf = module.create_transformation()
+        if len(transformations) > 0:
+            tf.share_resources(next(iter(transformations.values())))
+        transformations[name] = tf
+
+    for name, tf in transformations.items():
+        module = RECORD_TYPES[name]
+        if name == 'projects' and 'publications' in transformations:
+            tf.known_eprint_ids = transformations['publications'].eprint_ids
+        tf.transform_all(module.AREA_NAME, module.RECORD_NAME, **run_options(tf, args, name))
@@ -3,13 +3,21 @@ from rdb_harvest import HarvestFDBData
 
 from xml.etree import ElementTree as ET
 from datetime import datetime
-from itertools import zip_longest
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from contextlib import contextmanager
 import logging
 import collections
 import html
 import os
 import re
 import json
+import gzip
+import io
+import hashlib
+import math
+import sqlite3
+import threading
+import time
 
 import requests
 
@@ -20,6 +28,871 @@ from configparser import ConfigParser
 config = ConfigParser()
 config.read('default.cfg')
 
+"""Single characters replaced or removed in texts from the RDB, applied with chained str.replace calls. A
+str.translate table is slower, as it looks up every character of non-ASCII texts in Python."""
+HTML_TEXT_CHARACTERS = (
+    ('\x84', '"'),     # double low quotation mark
+    ('\xAD', ''),      # soft hyphen
+    ('\x96', '-'),     # en-Dash
+    ('\x97', '-'),     # em-Dash
+    ('\x93', '"'),     # left double quotation mark
+    ('\x94', '"'),     # right double quotation mark
+    ('\x95', '- '),    # bullet points
+    ('\x91', "'"),     # left single quotation mark
+    ('\x92', "'"),     # right single quotation mark
+    ('\x0A', ''),      # line feeds
+    ('\u00AC', ''),    # not sign
+)
+HTML_COMMENT = re.compile('<!--.*?-->')
+HTML_BREAK = re.compile('<br\\ >')
+HTML_TAG = re.compile('<[^<]+?>')
+WORD_STYLE = re.compile('Normal .*?bidi;\\}')
+
+
+def clean_html_text(text):
+    """Removes html, special characters and surplus whitespace from a text from the RDB.
+
+    The markup patterns only run if the text contains markup at all. They are not merged into a single pattern,
+    because removing a comment or a <br > can turn a stray '<' (e.g. 'p<0.05') into the start of a tag."""
+    text = html.unescape(text)                  # replace html escaped characters with plain text
+    if '<' in text:
+        text = HTML_COMMENT.sub('', text)       # remove xml comments (Doc Style Documentation)
+        text = HTML_BREAK.sub(' ', text)        # replace <br\ > tags with spaces
+        text = HTML_TAG.sub('', text)           # remove html tags
+    for character, replacement in HTML_TEXT_CHARACTERS:
+        text = text.replace(character, replacement)
+    text = ' '.join(text.split())               # replace any collection of whitespace characters with a single space.
+    if 'bidi;}' in text:
+        text = WORD_STYLE.sub('', text)         # HACK: special stuff that for some reason isn't removed with the HTML Tags.
+    return text.strip()                         # remove trailing & leading white space
+
+
+class Profiler(object):
+    """Counts the calls and the time spent in the stages, field functions and lookups of a run.
+
+    Durations are kept in a histogram with buckets of about 5 %, so the 95th percentile is an estimate which is
+    at most 5 % too high. While the profiler is disabled measure and iterate do nothing."""
+
+    BUCKETS_PER_E = 20
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stats = dict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def reset(self):
+        self.stats.clear()
+
+    def add(self, name, seconds):
+        bucket = math.floor(math.log(max(seconds, 1e-9)) * self.BUCKETS_PER_E)
+        with self._lock:
+            if name not in self.stats:
+                self.stats[name] = [0, 0.0, collections.Counter()]
+            stats = self.stats[name]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2][bucket] += 1
+
+    def merge(self, stats):
+        """Adds the stats of another profiler, e.g. of a worker process."""
+        with self._lock:
+            for name, (calls, total, histogram) in stats.items():
+                if name not in self.stats:
+                    self.stats[name] = [0, 0.0, collections.Counter()]
+                self.stats[name][0] += calls
+                self.stats[name][1] += total
+                self.stats[name][2].update(histogram)
+
+    @contextmanager
+    def measure(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def iterate(self, name, iterable):
+        """Yields from iterable and measures the time each item takes to produce."""
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, time.perf_counter() - start)
+                return
+            self.add(name, time.perf_counter() - start)
+            yield item
+
+    def percentile(self, name, percent):
+        calls, _, histogram = self.stats[name]
+        rank = calls * percent / 100
+        seen = 0
+        for bucket in sorted(histogram):
+            seen += histogram[bucket]
+            if seen >= rank:
+                return math.exp((bucket + 1) / self.BUCKETS_PER_E)
+        return 0.0
+
+    def report(self):
+        """Returns a table of all measurements ordered by total time."""
+        lines = ['{:<60} {:>10} {:>12} {:>12} {:>12}'.format('name', 'calls', 'total s', 'mean ms', 'p95 ms')]
+        for name, (calls, total, _) in sorted(self.stats.items(), key=lambda item: -item[1][1]):
+            lines.append('{:<60} {:>10} {:>12.3f} {:>12.3f} {:>12.3f}'.format(
+                name, calls, total, total / calls * 1000, self.percentile(name, 95) * 1000))
+        return '\n'.join(lines) + '\n'
+
+
+class ProfiledFunction(object):
+    """Wraps a field function to measure its calls. A class instead of a closure, so it can be sent to workers."""
+
+    def __init__(self, profiler, name, function):
+        self.profiler = profiler
+        self.name = name
+        self.function = function
+        self.__name__ = function.__name__
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.function(*args, **kwargs)
+        finally:
+            self.profiler.add(self.name, time.perf_counter() - start)
+
+
+class Diagnostics(object):
+    """Counts the issues found in the records by record type, field and kind.
+
+    For each kind of issue the first ids of the affected records are kept as samples. The messages of single
+    records are only logged in verbose mode. At the end of the run the summary is written to a file and one line
+    per kind of issue is logged."""
+
+    def __init__(self, logger, record_type='', verbose=None, samples=None):
+        self.logger = logger
+        self.record_type = record_type
+        self.verbose = verbose if verbose is not None else config.getboolean('diagnostics', 'verbose',
+                                                                             fallback=False)
+        self.samples = samples if samples is not None else config.getint('diagnostics', 'samples', fallback=20)
+        self.issues = dict()
+
+    def reset(self):
+        self.issues.clear()
+
+    def report(self, level, field, kind, record_id, message, *args):
+        """Counts an issue of kind in field of record_id. message is formatted with args and logged with level in
+        verbose mode."""
+        key = (self.record_type, field, kind)
+        issue = self.issues.get(key)
+        if issue is None:
+            issue = self.issues[key] = [level, 0, list()]
+        issue[1] += 1
+        if len(issue[2]) < self.samples and record_id not in issue[2]:
+            issue[2].append(record_id)
+        if self.verbose:
+            self.logger.log(level, message, *args)
+
+    def merge(self, issues):
+        """Adds the issues of another collector, e.g. of a worker process."""
+        for key, (level, count, samples) in issues.items():
+            issue = self.issues.get(key)
+            if issue is None:
+                issue = self.issues[key] = [level, 0, list()]
+            issue[1] += count
+            issue[2].extend(sample for sample in samples if sample not in issue[2])
+            del issue[2][self.samples:]
+
+    def summary(self):
+        return [{'record_type': record_type, 'field': field, 'kind': kind, 'level': logging.getLevelName(level),
+                 'count': count, 'samples': samples}
+                for (record_type, field, kind), (level, count, samples)
+                in sorted(self.issues.items(), key=lambda item: (-item[1][1], item[0]))]
+
+    def write(self, path=None):
+        """Logs one line per kind of issue and writes the summary to path if given."""
+        if path is not None:
+            with open(path, 'w') as file:
+                json.dump({'issues': self.summary()}, file, indent=2)
+        for (record_type, field, kind), (level, count, samples) in sorted(self.issues.items()):
+            self.logger.log(level, '%s %s: %s %s times, e.g. in records %s.', record_type, field, kind, count,
+                            ', '.join(str(sample) for sample in samples[:5]))
+
+
+class ResolverCache(object):
+    """Persistent cache for the answers of external lookups.
+
+    The answers are stored as JSON in a SQLite database keyed by kind and key and expire after ttl seconds. The
+    ttl can be overwritten per kind with the option <kind>_ttl in the cache section of the config. Recently used
+    answers are kept in memory as well. The connection is opened lazily, so that every worker process opens its own.
+    """
+
+    def __init__(self, path=None, ttl=None, lru_size=10000):
+        self.path = path if path is not None else config.get('cache', 'path', fallback='resolver_cache.sqlite')
+        self.ttl = ttl if ttl is not None else config.getint('cache', 'ttl', fallback=7 * 24 * 60 * 60)
+        self.lru_size = lru_size
+        self._lru = collections.OrderedDict()
+        self._connection = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        state['_lru'] = collections.OrderedDict()
+        return state
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS cache (kind TEXT, key TEXT, value TEXT, '
+                                     'created REAL, PRIMARY KEY (kind, key))')
+        return self._connection
+
+    def ttl_of(self, kind):
+        return config.getint('cache', kind + '_ttl', fallback=self.ttl)
+
+    def get_many(self, kind, keys):
+        """Returns a dict with the cached answers of all keys which are known and not expired."""
+        found = dict()
+        missing = list()
+        for key in keys:
+            if (kind, key) in self._lru:
+                self._lru.move_to_end((kind, key))
+                found[key] = self._lru[(kind, key)]
+            else:
+                missing.append(key)
+
+        oldest = time.time() - self.ttl_of(kind)
+        for i in range(0, len(missing), 500):
+            batch = missing[i:i + 500]
+            rows = self.connection.execute('SELECT key, value FROM cache WHERE kind = ? AND created >= ? AND key IN '
+                                           '({})'.format(','.join('?' * len(batch))), [kind, oldest] + batch)
+            for key, value in rows:
+                found[key] = json.loads(value)
+                self._remember(kind, key, found[key])
+        return found
+
+    def set_many(self, kind, answers):
+        now = time.time()
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                                        [(kind, key, json.dumps(value), now) for key, value in answers.items()])
+        for key, value in answers.items():
+            self._remember(kind, key, value)
+
+    def _remember(self, kind, key, value):
+        self._lru[(kind, key)] = value
+        self._lru.move_to_end((kind, key))
+        if len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+
+class EdocSnapshot(object):
+    """A local copy of the edoc and RDB persons indices, used instead of Elasticsearch for affiliated publications
+    and DNIs.
+
+    The snapshot is a SQLite database written once by build. It maps the mcss ids of edoc documents to their
+    eprints ids and the DNIs to the edoc contributors of the first document with this DNI or to all persons with
+    this DNI in RDB. The connection is opened read only and lazily, so that every worker process opens its own.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        return state
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect('file:{}?mode=ro'.format(self.path), uri=True)
+        return self._connection
+
+    @classmethod
+    def build(cls, path, edoc, fdb, edoc_index, fdb_index, logger=logging.getLogger(__name__.split('.')[-1])):
+        """Scrolls through the edoc index and the RDB persons index once and writes a new snapshot to path."""
+        partial = path + '.partial'
+        if os.path.isfile(partial):
+            os.remove(partial)
+        connection = sqlite3.connect(partial)
+        with connection:
+            connection.execute('CREATE TABLE info (name TEXT PRIMARY KEY, value TEXT)')
+            connection.execute('CREATE TABLE eprints (source TEXT, mcss_id INTEGER, eprintid INTEGER)')
+            connection.execute('CREATE TABLE contributors (source TEXT, dni INTEGER, value TEXT, '
+                               'PRIMARY KEY (source, dni))')
+            connection.execute('CREATE TABLE persons (source TEXT, dni INTEGER, value TEXT)')
+
+            documents = 0
+            query = {'_source': ['eprintid', 'mcss_id', 'contributors'], 'query': {'match_all': {}}}
+            for result in edoc.scan_index(query):
+                documents += 1
+                if result.get('mcss_id') is not None:
+                    connection.execute('INSERT INTO eprints VALUES (?, ?, ?)',
+                                       (edoc_index, int(result['mcss_id']), result['eprintid']))
+                contributors = dict()
+                for contrib in result.get('contributors', list()):
+                    try:
+                        contributors.setdefault(int(contrib['dni']), list()).append(contrib)
+                    except (KeyError, ValueError, TypeError):
+                        pass
+                # only the first document with a DNI is used, like the terms query in _search_contributors.
+                connection.executemany('INSERT OR IGNORE INTO contributors VALUES (?, ?, ?)',
+                                       [(edoc_index, dni, json.dumps(contribs))
+                                        for dni, contribs in contributors.items()])
+
+            persons = 0
+            skipped = 0
+            for result in fdb.scan_index({'query': {'match_all': {}}}):
+                try:
+                    dni = int(result['dni'])
+                except (KeyError, ValueError, TypeError):
+                    skipped += 1
+                    continue
+                persons += 1
+                connection.execute('INSERT INTO persons VALUES (?, ?, ?)', (fdb_index, dni, json.dumps(result)))
+
+            connection.execute('CREATE INDEX eprints_mcss_id ON eprints (source, mcss_id)')
+            connection.execute('CREATE INDEX persons_dni ON persons (source, dni)')
+            connection.executemany('INSERT INTO info VALUES (?, ?)', [
+                ('created', datetime.now().isoformat()), ('edoc_index', edoc_index), ('fdb_index', fdb_index)])
+        connection.close()
+        os.replace(partial, path)
+        logger.info('Wrote a snapshot of %s edoc documents and %s RDB persons to %s.', documents, persons, path)
+        if skipped > 0:
+            logger.warning('Skipped %s RDB persons without a valid DNI.', skipped)
+        return cls(path)
+
+    def eprint_ids(self, index, mcss_ids):
+        """Returns a dict with the eprints ids of all documents with one of the given mcss ids."""
+        return self._select('SELECT mcss_id, eprintid FROM eprints WHERE source = ? AND mcss_id IN ({}) ORDER BY rowid',
+                            index, mcss_ids)
+
+    def contributors(self, index, fdb_index, dnis):
+        """Returns the answers for the DNIs in the same form as _search_contributors."""
+        found = {dni: json.loads(value[0]) for dni, value in self._select(
+            'SELECT dni, value FROM contributors WHERE source = ? AND dni IN ({})', index,
+            {int(dni) for dni in dnis}).items()}
+        persons = self._select('SELECT dni, value FROM persons WHERE source = ? AND dni IN ({}) ORDER BY rowid',
+                               fdb_index, {int(dni) for dni in dnis if int(dni) not in found})
+
+        answers = dict()
+        for dni in dnis:
+            if int(dni) in found:
+                answers[dni] = {'source': 'edoc',
+                                'contributors': [contrib for contrib in found[int(dni)] if str(contrib['dni']) == dni]}
+            else:
+                answers[dni] = {'source': 'fdb', 'persons': [json.loads(value) for value in persons.get(int(dni), list())]}
+        return answers
+
+    def _select(self, statement, source, keys):
+        """Returns the values of statement grouped by key, queried in batches of keys."""
+        keys = sorted(keys)
+        values = dict()
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            for key, value in self.connection.execute(statement.format(','.join('?' * len(batch))), [source] + batch):
+                values.setdefault(key, list()).append(value)
+        return values
+
+
+class DoiValidator(object):
+    """Checks DOIs against the doi.org handle API in the background.
+
+    The requests are sent by a pool of threads over a single session, so connections to doi.org are kept alive
+    and reused. At most concurrency requests are running at the same time and at most max_pending are waiting, after
+    which submit blocks until the oldest one is done. The results are logged when they are collected.
+
+    Known answers are taken from the cache. In offline mode DOIs which are not in the cache are not validated.
+    """
+
+    def __init__(self, logger, cache, offline=False, concurrency=None, timeout=None, max_pending=1000, profiler=None,
+                 diagnostics=None):
+        self.logger = logger
+        self.cache = cache
+        self.offline = offline
+        self.profiler = profiler if profiler is not None else Profiler()
+        self.diagnostics = diagnostics if diagnostics is not None else Diagnostics(logger)
+        self.concurrency = concurrency if concurrency is not None else config.getint('doi', 'concurrency', fallback=16)
+        self.timeout = timeout if timeout is not None else config.getfloat('doi', 'timeout', fallback=10)
+        self.max_pending = max_pending
+        self._executor = None
+        self._session = None
+        self._pending = collections.deque()
+        self._answers = dict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        state['_session'] = None
+        state['_pending'] = collections.deque()
+        state['_answers'] = dict()
+        return state
+
+    def submit(self, doi, text, record_id):
+        """Queues the validation of doi. text and record_id are only used for logging."""
+        cached = self.cache.get_many('doi', [doi])
+        if doi in cached:
+            future = Future()
+            future.set_result(cached[doi])
+            self._pending.append((future, doi, text, record_id))
+            self.collect()
+            return
+        if self.offline:
+            self.diagnostics.report(logging.INFO, 'doi', 'not validated offline', record_id,
+                                    'DOI %s is not cached and was not validated in offline mode.', doi)
+            return
+
+        if self._executor is None:
+            self._session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+            self._session.mount('https://', adapter)
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self._pending.append((self._executor.submit(self._validate, doi), doi, text, record_id))
+        if len(self._pending) > self.max_pending:
+            self._log(*self._pending.popleft())
+        self.collect()
+
+    def _validate(self, doi):
+        with self.profiler.measure('lookup: doi.org'):
+            return self._request(doi)
+
+    def _request(self, doi):
+        response = self._session.get('https://doi.org/api/handles/' + doi, timeout=self.timeout)
+        return json.loads(response.text)['responseCode']
+
+    def collect(self, wait=False):
+        """Logs the results of the finished validations in the order they were submitted. With wait all pending
+        validations are waited for."""
+        while len(self._pending) > 0 and (wait or self._pending[0][0].done()):
+            self._log(*self._pending.popleft())
+        if len(self._answers) > 0:
+            self.cache.set_many('doi', self._answers)
+            self._answers = dict()
+
+    def close(self):
+        self.collect(wait=True)
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._session.close()
+            self._executor = None
+            self._session = None
+
+    def _log(self, future, doi, text, record_id):
+        try:
+            response_code = future.result()
+        except Exception as error:
+            self.logger.error('Could not access doi resolver, because %s.', str(error))
+        else:
+            # 2 is an error on the side of doi.org and is asked again next time.
+            if response_code in (1, 100, 200):
+                self._answers[doi] = response_code
+            if response_code == 1:
+                if self.diagnostics.verbose:
+                    self.logger.info('DOI Found.')
+            elif response_code == 2:
+                self.diagnostics.report(logging.ERROR, 'doi', 'handle resolution failed', record_id,
+                                        'Something unexpected went wrong during handle resolution. '
+                                        '(HTTP 500 Internal Server Error).')
+            elif response_code == 100:
+                self.diagnostics.report(logging.ERROR, 'doi', 'handle not found', record_id,
+                                        'Handle %s not found for record %s.', text, record_id)
+            elif response_code == 200:
+                self.diagnostics.report(logging.WARNING, 'doi', 'handle without values', record_id,
+                                        'Values Not Found. The handle %s exists but has no values (or no values '
+                                        'according to the types and indices specified). (HTTP 200 OK) for record %s.',
+                                        text, record_id)
+
+"""Text files written alongside the transformation. The path can be changed per record type with the option
+<record_type>_<name> in the side-output section of the config. An empty path disables the file."""
+SIDE_OUTPUTS = {
+    'titles': 'titles.txt',
+    'fulltext': 'edoc-rdb-fulltext.txt'
+}
+
+
+class SideOutput(object):
+    """A text file which is written alongside the transformation.
+
+    Lines are buffered and appended to the file when flushed. The file is opened once. In worker processes the
+    lines are not written but taken and sent to the main process, which writes them in harvest file order.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._buffer = list()
+        self._file = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_buffer'] = list()
+        return state
+
+    def write(self, line):
+        self._buffer.append(line + '\n')
+
+    def take(self):
+        lines = self._buffer
+        self._buffer = list()
+        return lines
+
+    def extend(self, lines):
+        self._buffer.extend(lines)
+
+    def flush(self):
+        if len(self._buffer) > 0:
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(''.join(self._buffer))
+            self._file.flush()
+            self._buffer = list()
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class OrganisationIndex(object):
+    """The organisation hierarchy of the RDB, indexed by mcssid.
+
+    Built in a single pass over the organisation csv. The index is cached next to the csv, keyed by the hash of the
+    csv, and kept in memory, so that all record types of a process share it.
+    """
+
+    _loaded = dict()
+
+    def __init__(self, nodes):
+        # mcssid -> (name, mcssid of the first parent)
+        self.nodes = nodes
+        self.departments = {mcssid: self.nodes[parent][0] if parent in self.nodes else ''
+                            for mcssid, (name, parent) in self.nodes.items()}
+
+    @classmethod
+    def load(cls, organisation_file):
+        with open(organisation_file, 'rb') as file:
+            digest = hashlib.sha1(file.read()).hexdigest()
+        if digest in cls._loaded:
+            return cls._loaded[digest]
+
+        cache_path = organisation_file + '.index.json'
+        nodes = None
+        if os.path.isfile(cache_path):
+            with open(cache_path, 'r') as file:
+                cached = json.load(file)
+            if cached['hash'] == digest:
+                nodes = {mcssid: tuple(node) for mcssid, node in cached['nodes'].items()}
+        if nodes is None:
+            nodes = dict()
+            with open(organisation_file, 'r') as csvfile:
+                for row in DictReader(csvfile):
+                    nodes[row['mcssid']] = (row['name'], row['parent_mcssid'].split(',')[0])
+            with open(cache_path, 'w') as file:
+                json.dump({'hash': digest, 'nodes': nodes}, file)
+
+        cls._loaded[digest] = cls(nodes)
+        return cls._loaded[digest]
+
+    def parent(self, mcssid):
+        """Returns the mcssid of the parent or None."""
+        parent = self.nodes[mcssid][1]
+        return parent if parent in self.nodes else None
+
+    def department(self, mcssid):
+        """Returns the name of the parent organisation or an empty string. Raises KeyError for unknown ids."""
+        return self.departments[mcssid]
+
+    def ancestors(self, mcssid):
+        """Yields the mcssids of all organisations above mcssid, starting with its parent."""
+        seen = {mcssid}
+        parent = self.parent(mcssid)
+        while parent is not None and parent not in seen:
+            yield parent
+            seen.add(parent)
+            parent = self.parent(parent)
+
+
+"""The start tag of an OAI-PMH record with or without namespace prefix, see _count_records."""
+RECORD_START_TAG = re.compile(rb'<(?:[\w.-]+:)?record[\s/>]')
+
+
+"""Fields which are read by transform_record to keep track of the record being transformed."""
+RECORD_CONTEXT_FIELDS = {'title', 'identifier', 'type', 'pubtype_weboffice', 'month_day'}
+
+
+class RecordParser(object):
+    """Parser target which builds the records of a harvest file one at a time and applies the import filter
+    while parsing.
+
+    Of the fields below field_path only those in fields are built completely. Other fields are built without
+    content, so that they can still be reported as not transformed. As soon as the filter field which decides
+    about a record has been read and rejects it, the rest of the record is skipped.
+
+    The import filter is applied like filter_record: the last filter in import_filter which is present in the
+    record decides. The completed children of ListRecords are collected in records, with None in place of
+    everything which is not an imported record. Rejected records are collected in rejected as tuples of the
+    OAI identifier, the deciding filter and its value. Records marked as deleted in their OAI header are
+    rejected as well and collected in deleted by their OAI identifier.
+
+    The RDB identifiers of all rejected and deleted records are collected in withdrawn. A deleted record has no
+    metadata, its RDB identifier is the part of the OAI identifier after the last colon."""
+
+    def __init__(self, import_filter, field_path, fields):
+        self.import_filter = import_filter
+        self.filters = list(import_filter)
+        self.field_path = ['record'] + [part for part in field_path.split('/') if part not in ('', '.')]
+        self.fields = fields
+        self.records = list()
+        self.rejected = list()
+        self.deleted = list()
+        self.withdrawn = list()
+        self._tags = dict()
+        self._depth = 0
+        self._record_depth = None
+        self._field_depth = None
+        # the tags of the record and its descendants down to the parent of the fields.
+        self._ancestors = [None] * len(self.field_path)
+        self._builder = None
+        self._building = False
+        self._skip_depth = None
+        self._values = dict()
+        self._identifier = None
+        self._record_id = None
+        self._deleted = False
+        self._decided = None
+
+    def _strip(self, tag):
+        try:
+            return self._tags[tag]
+        except KeyError:
+            self._tags[tag] = tag.split('}', 1)[-1]
+            return self._tags[tag]
+
+    def start(self, tag, attrib):
+        self._depth += 1
+        depth = self._depth
+        if self._building:
+            tag = self._strip(tag)
+            self._builder.start(tag, attrib)
+            if depth < self._field_depth:
+                self._ancestors[depth - self._record_depth] = tag
+                if depth == self._record_depth + 1 and tag == 'header' and attrib.get('status') == 'deleted':
+                    self._deleted = True
+            elif depth == self._field_depth and tag not in self.fields and self._ancestors == self.field_path:
+                self._skip_depth = depth
+                self._building = False
+        elif self._skip_depth is not None:
+            return
+        elif depth == self._record_depth:
+            tag = self._strip(tag)
+            if tag == 'record':
+                self._builder = ET.TreeBuilder()
+                self._builder.start(tag, attrib)
+                self._building = True
+                self._ancestors[0] = tag
+                self._values = dict()
+                self._identifier = None
+                self._record_id = None
+                self._deleted = False
+        elif self._record_depth is None and self._strip(tag) == 'ListRecords':
+            self._record_depth = depth + 1
+            self._field_depth = depth + len(self.field_path) + 1
+
+    def data(self, data):
+        if self._building:
+            self._builder.data(data)
+
+    def end(self, tag):
+        depth = self._depth
+        self._depth -= 1
+        if self._building:
+            element = self._builder.end(self._tags[tag])
+            if depth == self._field_depth:
+                tag = element.tag
+                if tag == 'identifier' and self._record_id is None and self._ancestors == self.field_path:
+                    self._record_id = element.text
+                if tag in self.import_filter and tag not in self._values and self._ancestors == self.field_path:
+                    self._values[tag] = element.text
+                    # nothing can override the last filter, so a rejected record can be skipped from here on,
+                    # once its identifier is known.
+                    if tag == self.filters[-1]:
+                        self._decided = self._decide()
+                        if not self._decided[2] and self._record_id is not None:
+                            self._skip_depth = self._record_depth
+                            self._building = False
+            elif depth == self._record_depth:
+                self._decided = self._decide()
+                if self._decided[2] and not self._deleted:
+                    self.records.append(element)
+                    self._builder = None
+                    self._building = False
+                else:
+                    self._reject()
+            elif depth == self._record_depth + 2 and element.tag == 'identifier' and self._ancestors[1] == 'header':
+                self._identifier = element.text
+        elif self._skip_depth is not None:
+            if depth == self._skip_depth == self._record_depth:
+                self._reject()
+            elif depth == self._skip_depth:
+                self._builder.end(self._tags[tag])
+                self._skip_depth = None
+                self._building = True
+        elif depth == self._record_depth:
+            self.records.append(None)
+
+    def _reject(self):
+        self.records.append(None)
+        if self._deleted:
+            self.deleted.append(self._identifier)
+        else:
+            self.rejected.append((self._identifier,) + self._decided[:2])
+        if self._record_id is not None:
+            self.withdrawn.append(self._record_id)
+        elif self._deleted and self._identifier is not None:
+            self.withdrawn.append(self._identifier.rsplit(':', 1)[-1])
+        self._builder = None
+        self._building = False
+        self._skip_depth = None
+
+    def close(self):
+        pass
+
+    def _decide(self):
+        return decide_import(self.import_filter, self._values)
+
+
+def decide_import(import_filter, values):
+    """Returns the deciding filter, its value and whether a record with the filter field values is imported.
+
+    Like filter_record the last filter in import_filter which is present in the record decides."""
+    for name in reversed(list(import_filter)):
+        if name in values:
+            return name, values[name], import_filter[name].get(values[name], False)
+    return None, None, False
+
+
+class ChunkWriter(object):
+    """Writes the records of an output file one at a time.
+
+    The file is the same as the serialisation of the complete area element. With compress it is written with
+    gzip. The gzip header contains neither file name nor time, so the compressed files are reproducible as well.
+    The identifiers of the records and the uncompressed size of the records written so far are kept for the shard
+    manifest, see entry.
+    """
+
+    def __init__(self, path, area_name, compress=False):
+        self.path = path
+        self.area_name = area_name
+        self.count = 0
+        self.size = 0
+        self.ids = list()
+        if compress:
+            self._raw = open(path, 'wb')
+            self.file = io.TextIOWrapper(gzip.GzipFile(filename='', mode='wb', fileobj=self._raw, mtime=0),
+                                         encoding='utf-8')
+        else:
+            self._raw = None
+            self.file = open(path, 'w', encoding='utf-8')
+        self.file.write('<' + area_name)
+
+    def write(self, record, identifier=None):
+        if self.count == 0:
+            self.file.write('>')
+        text = ET.tostring(record, encoding='unicode')
+        self.file.write(text)
+        self.size += len(text.encode('utf-8'))
+        self.ids.append(identifier)
+        self.count += 1
+
+    def close(self):
+        self.file.write(' />' if self.count == 0 else '</{}>'.format(self.area_name))
+        self.file.close()
+        if self._raw is not None:
+            self._raw.close()
+        return self.path
+
+    def entry(self, harvest_file):
+        """Describes the closed file for the shard manifest."""
+        digest = hashlib.sha1()
+        with open(self.path, 'rb') as file:
+            for block in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(block)
+        return {'file': os.path.basename(self.path), 'harvest_file': harvest_file, 'records': self.count,
+                'ids': self.ids, 'bytes': os.path.getsize(self.path), 'sha1': digest.hexdigest()}
+
+
+class ShardWriter(object):
+    """Writes records to shards of at most records records each. With size a shard is closed as soon as it
+    reaches size bytes (uncompressed).
+
+    The shards are named with prefix and their number. A shard is only opened when a record is written to it, so
+    a harvest file without imported records has no shards.
+    """
+
+    def __init__(self, prefix, area_name, harvest_file, compress=False, records=None, size=None):
+        self.prefix = prefix
+        self.area_name = area_name
+        self.harvest_file = harvest_file
+        self.compress = compress
+        self.records = records
+        self.size = size
+        self.shards = list()
+        self._writer = None
+
+    def write(self, record, identifier=None):
+        if self._writer is None:
+            self._writer = ChunkWriter('{}-{}.xml{}'.format(self.prefix, len(self.shards),
+                                                            '.gz' if self.compress else ''),
+                                       self.area_name, compress=self.compress)
+        self._writer.write(record, identifier)
+        if self.records is not None and self._writer.count >= self.records or \
+                self.size is not None and self._writer.size >= self.size:
+            self._close_shard()
+
+    def _close_shard(self):
+        self._writer.close()
+        self.shards.append(self._writer.entry(self.harvest_file))
+        self._writer = None
+
+    def close(self):
+        """Closes the last shard and returns the manifest entries of all shards."""
+        if self._writer is not None:
+            self._close_shard()
+        return self.shards
+
+
+"""The transformation of the worker process, see _init_worker."""
+_worker_transformation = None
+
+
+def _init_worker(transformation):
+    """Keeps the transformation in the worker process, so that it is sent once per worker instead of with every
+    harvest file."""
+    global _worker_transformation
+    _worker_transformation = transformation
+    _worker_transformation._manifest = dict()
+
+
+def _transform_file_task(item, entry, area_name, record_name, size):
+    return _worker_transformation._transform_file_in_worker(item, entry, area_name, record_name, size)
+
 
 class TransformFDBRecord(collections.Sequence):
 
@@ -30,7 +903,8 @@ class TransformFDBRecord(collections.Sequence):
                  ignore_list: set,
                  target_path: str,
                  organisation_file = 'data/organisation.csv',
-                 logger=logging.getLogger(__name__.split('.')[-1])):
+                 logger=logging.getLogger(__name__.split('.')[-1]),
+                 offline=config.getboolean('cache', 'offline', fallback=False)):
 
         self.record_type = record_type
         self.data_path = data_base_path
@@ -46,14 +920,39 @@ class TransformFDBRecord(collections.Sequence):
         self.current_type = ''
         self.current_subtype = ''
         self.month_day = ''
-
-        self.full_text_logger = logging.getLogger('fulltext')
-        self.full_text_logger.setLevel(logging.INFO)
-
-        file_handler = logging.FileHandler('edoc-rdb-fulltext.txt')
-        formatter = logging.Formatter('%(message)s')
-        file_handler.setFormatter(formatter)
-        self.full_text_logger.addHandler(file_handler)
+        self._manifest = None
+        self._record = None
+        self._slots = dict()
+        self.incremental = False
+        self.record_state = dict()
+        self._seen_records = dict()
+        self._config_hash = b''
+        self.compress = False
+        self.shard_records = None
+        self.shard_bytes = None
+        self._record_ids = list()
+        self.write_batch_size = config.getint('output', 'write_batch_size', fallback=100)
+        self._elastic_clients = dict()
+        self._pending_publications = list()
+        self._pending_contributors = list()
+        self._pending_pmids = list()
+        self.eprint_ids = dict()
+        self.known_eprint_ids = dict()
+        self._http_session = None
+        self.offline = offline
+        self.cache = ResolverCache()
+        snapshot = config.get('snapshot', 'path', fallback='')
+        self.snapshot = EdocSnapshot(snapshot) if snapshot != '' else None
+        self.profiler = Profiler()
+        self.diagnostics = Diagnostics(self.logger, record_type)
+        self.doi_validator = DoiValidator(self.logger, self.cache, offline=offline, profiler=self.profiler,
+                                          diagnostics=self.diagnostics)
+
+        self.side_outputs = dict()
+        for name, default in SIDE_OUTPUTS.items():
+            path = config.get('side-output', '{}_{}'.format(record_type, name), fallback=default)
+            if path != '':
+                self.side_outputs[name] = SideOutput(path)
 
 
         self.publication_types = {
@@ -70,57 +969,251 @@ class TransformFDBRecord(collections.Sequence):
             'Publication: Thesis (Dissertationen, Habilitationen)': 'thesis'
         }
 
-        with open(organisation_file, 'r') as csvfile:
-            organisation = DictReader(csvfile)
-            all_organisations = list()
-            for row in organisation:
-                all_organisations.append(row)
-
-        self.departments = dict()
-        for row in all_organisations:
-            departement_name = ''
-            parent_id = row['parent_mcssid'].split(',')[0]
-            for second_row in all_organisations:
-                if parent_id == second_row['mcssid']:
-                    departement_name = second_row['name']
-            self.departments[row['mcssid']] = departement_name
-
-    def harvest(self, use_last_update=False):
+        self.publication_subtypes = {
+            'Review':'review',
+            'Rezension': 'book_review',
+            'Urteilsanmerkung': 'annotation',
+            'Aufsatz/Beitrag in Sammelband': 'chapter',
+            'Lexikonartikel': 'encyclopedia',
+            'Jur. Kommentierung': 'commentary',
+            'Übersetzung': 'contribution'
+        }
+
+        # The note and the subtype only depend on type and pubtype weboffice. They are computed once for all known
+        # values, unknown values are added when they first occur.
+        self.type_notes = dict()
+        self.subtypes_by_type = dict()
+        if self.record_type == 'pub':
+            for pub_type in self.publication_types:
+                self.type_notes[pub_type] = self._note_from_type(pub_type)
+                for subtype in list(self.publication_subtypes) + ['Edition', None]:
+                    self.subtypes_by_type[(subtype, pub_type)] = self._subtype_from_type(subtype, pub_type)
+
+        self.organisations = OrganisationIndex.load(organisation_file)
+        self.departments = self.organisations.departments
+
+    def __getstate__(self):
+        # elastic clients hold open connections and are recreated in each worker process. The results collected
+        # during a run stay in the main process.
+        state = self.__dict__.copy()
+        state['_elastic_clients'] = dict()
+        state['_http_session'] = None
+        state['_seen_records'] = dict()
+        state['eprint_ids'] = dict()
+        state['_manifest'] = None
+        return state
+
+    def share_resources(self, other):
+        """Uses the resolver cache and the elastic clients of other, to share them between the record types of a
+        run. The organisation index is shared by OrganisationIndex.load already."""
+        self.cache = other.cache
+        self.doi_validator.cache = other.cache
+        self._elastic_clients = other._elastic_clients
+
+    def _elastic(self, index, doc_type, url):
+        """Returns a client for the given index, which is reused for the whole run."""
+        key = (index, doc_type, url)
+        if key not in self._elastic_clients:
+            self._elastic_clients[key] = ElasticIndex(index, doc_type, url=url)
+        return self._elastic_clients[key]
+
+    def harvest(self, use_last_update=False, resume=False):
+        """Harvests the records from the RDB.
+
+        The start of the harvest is kept as the pending watermark in the checkpoint. It only becomes the last update
+        once transform_all completed. With resume the harvest is skipped if the harvest of the interrupted run
+        already completed."""
+        checkpoint = self.checkpoint
+        if resume and checkpoint.get('harvested', False):
+            self.logger.info('Harvest of %s already completed, resuming with the transformation.', self.record_type)
+            return
+        date = self.last_update if use_last_update else None
+        checkpoint = self._start_harvest(date is not None)
+        self._run_harvester(date)
+        self._manifest = None
+
+        checkpoint['harvested'] = True
+        self._save_checkpoint(checkpoint)
+
+    def _start_harvest(self, delta=False):
+        """Keeps the start of the harvest as the pending watermark in the checkpoint and returns the checkpoint.
+        delta marks a harvest of the records changed since the last update only."""
+        checkpoint = {'watermark': self.checkpoint.get('watermark'),
+                      'pending_watermark': datetime.today().strftime('%d-%m-%Y %H:%M:%S'),
+                      'harvested': False,
+                      'delta': delta}
+        self._save_checkpoint(checkpoint)
+        return checkpoint
+
+    def _run_harvester(self, date):
         harvester = HarvestFDBData(user=config['fdb-harvest']['user'],
                                    password=config['fdb-harvest']['password'],
                                    base_path=self.data_path)
-        harvester.harvest(self.record_type, date=self.last_update if use_last_update else None)
+        harvester.harvest(self.record_type, date=date)
+
+    def _harvest_in_background(self, use_last_update=False, poll_interval=None):
+        """Starts the harvest in a background thread and returns an iterator over the manifest indexes of the harvest
+        files, see _iter_harvested."""
+        existing = {file_name: self._file_version(file_name) for file_name in self._list_harvest_files()}
+        date = self.last_update if use_last_update else None
+        self._start_harvest(date is not None)
+        self._manifest = list()
+        executor = ThreadPoolExecutor(max_workers=1)
+        harvester = executor.submit(self._run_harvester, date)
+        # the harvest keeps running, the thread ends with it.
+        executor.shutdown(wait=False)
+        return self._iter_harvested(harvester, existing, poll_interval)
+
+    def _iter_harvested(self, harvester, existing, poll_interval=None):
+        """Adds each harvest file to the manifest as soon as the harvester completed it and yields its index.
+
+        existing maps the files which existed before the harvest to their mtime and size. A file is written by the
+        harvest if it is new or if its mtime or size changed since. The harvester writes one response file after
+        the other, so such a file is complete once a newer file was written or the harvest finished. Files which
+        the harvest did not write are complete once it finished. The files are added in name order, the same as
+        in the manifest of a separate harvest. Errors of the harvester are raised after the last file."""
+        if poll_interval is None:
+            poll_interval = config.getfloat('pipeline', 'poll_interval', fallback=0.5)
+        previous = self._stored_manifest()
+        known = set()
+        while True:
+            finished = harvester.done()
+            pending = [file_name for file_name in self._list_harvest_files() if file_name not in known]
+            complete = set(pending)
+            if not finished:
+                written = sorted((version, file_name) for version, file_name in
+                                 ((self._file_version(file_name), file_name) for file_name in pending)
+                                 if existing.get(file_name) != version)
+                complete = {file_name for _, file_name in written[:-1]}
+            added = 0
+            for file_name in pending:
+                if file_name not in complete:
+                    break
+                known.add(file_name)
+                added += 1
+                with self.profiler.measure('io: manifest'):
+                    self._manifest.append(self._manifest_entry(file_name, previous.get(file_name)))
+                yield len(self._manifest) - 1
+            if finished:
+                harvester.result()
+                return
+            if added == 0:
+                time.sleep(poll_interval)
+
+    @staticmethod
+    def _file_version(file_name):
+        """The mtime and size of a file, which change when the harvest writes it."""
+        stat = os.stat(file_name)
+        return stat.st_mtime, stat.st_size
 
     @property
     def last_update(self):
-        last_update = None
-        with open('last_update.txt', 'r') as file:
-            t = file.read()
-            if t != '':
-                last_update = datetime.strptime(t, '%d-%m-%Y %H:%M:%S')
-            if last_update is None:
-                last_update = datetime.today()
-
-        with open('last_update.txt', 'w') as file:
-            file.write(datetime.today().strftime('%d-%m-%Y %H:%M:%S'))
-        return last_update
+        """The start of the last harvest which was transformed completely.
+
+        Falls back to last_update.txt, which was used before the checkpoint, and then to today."""
+        last_update = self.checkpoint.get('watermark')
+        if last_update is None and os.path.isfile('last_update.txt'):
+            with open('last_update.txt', 'r') as file:
+                last_update = file.read().strip()
+        if last_update:
+            return datetime.strptime(last_update, '%d-%m-%Y %H:%M:%S')
+        return datetime.today()
+
+    @property
+    def checkpoint_path(self):
+        """The checkpoint is stored next to the data directory."""
+        return os.path.normpath(self.path) + '-checkpoint.json'
+
+    @property
+    def checkpoint(self):
+        """The state of the current run: the pending watermark, whether the harvest completed and which harvest
+        files were transformed completely. Also contains the watermark of the last completed run."""
+        if os.path.isfile(self.checkpoint_path):
+            with open(self.checkpoint_path, 'r') as file:
+                return json.load(file)
+        return dict()
+
+    def _save_checkpoint(self, checkpoint):
+        with self.profiler.measure('io: checkpoint'):
+            with open(self.checkpoint_path + '.tmp', 'w') as file:
+                json.dump(checkpoint, file, indent=2)
+            os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
 
     @property
     def path(self):
         return self.data_path + config['data'][self.record_type]
 
+    @property
+    def manifest_path(self):
+        """The manifest is stored next to the data directory."""
+        return os.path.normpath(self.path) + '-manifest.json'
+
+    @property
+    def manifest(self):
+        """A list of all harvest files with size, mtime and record count. Built once per run."""
+        if self._manifest is None:
+            self._manifest = self._build_manifest()
+        return self._manifest
+
+    def _build_manifest(self):
+        """Lists the harvest files in a single directory walk.
+
+        Record counts are reused from the stored manifest for every file whose size and mtime did not change.
+        The manifest is only rewritten if something changed."""
+        previous = self._stored_manifest()
+        manifest = [self._manifest_entry(file_name, previous.get(file_name))
+                    for file_name in self._list_harvest_files()]
+
+        if manifest != list(previous.values()):
+            self._write_manifest(manifest)
+        return manifest
+
+    def _stored_manifest(self):
+        """Returns the entries of the stored manifest by file name."""
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, 'r') as file:
+                try:
+                    return {entry['file']: entry for entry in json.load(file)}
+                except ValueError:
+                    self.logger.warning('Ignoring invalid manifest %s.', self.manifest_path)
+        return dict()
+
+    def _write_manifest(self, manifest):
+        with open(self.manifest_path, 'w') as file:
+            json.dump(sorted(manifest, key=lambda entry: entry['file']), file, indent=2)
+
+    def _list_harvest_files(self):
+        return sorted(os.path.join(root, file) for root, dirs, files in os.walk(self.path) for file in files)
+
+    def _manifest_entry(self, file_name, entry=None):
+        """Returns entry if the size and mtime of the file did not change, otherwise a new entry."""
+        stat = os.stat(file_name)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            entry = {'file': file_name, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                     'records': self._count_records(file_name)}
+        return entry
+
+    @staticmethod
+    def _count_records(file_name):
+        """Counts the record start tags with a scan over the bytes of the file instead of parsing it."""
+        with open(file_name, 'rb') as file:
+            return len(RECORD_START_TAG.findall(file.read()))
+
     @property
     def file_names(self):
-        return [root + file for root, dirs, files in os.walk(self.path) for file in files]
+        return [entry['file'] for entry in self.manifest]
+
+    @property
+    def record_count(self):
+        return sum(entry['records'] for entry in self.manifest)
 
     def __len__(self):
-        root, directories, files = os.walk(self.path)
-        return len(files)
+        return len(self.manifest)
 
     def __getitem__(self, item):
         logging.debug('Remove all namespace tags from XML elements for better processing.')
         # uses the encoding specified inside of the xml.
-        tree = ET.iterparse(self.file_names[item])
+        tree = ET.iterparse(self.manifest[item]['file'])
         # Remove namespaces as they are not properly supported in xmljson and would clutter the field names in ES.
         for _, element in tree:
             try:
@@ -130,6 +1223,50 @@ class TransformFDBRecord(collections.Sequence):
         logging.debug('Successfully removed all namespace tags from XML elements.')
         return tree.root.find('./ListRecords')
 
+    def iter_records(self, item, block_size=64 * 1024):
+        """Streams the records of a harvest file one at a time.
+
+        The import filter is applied while parsing, so rejected records are not built (see RecordParser). Yields
+        the imported records and None for every other child of ListRecords, so that chunks are counted the same
+        as with a complete parse. Namespaces are removed. The rejected and deleted records are reported to the
+        diagnostics. With incremental their identifiers are kept without a hash, so that _finish_incremental lists
+        them as removed.
+        """
+        target = RecordParser(self.import_filter, self.base_xml_path,
+                              set(self.functions) | set(self.import_filter) | RECORD_CONTEXT_FIELDS)
+        # uses the encoding specified inside of the xml.
+        parser = ET.XMLParser(target=target)
+        with open(self.manifest[item]['file'], 'rb') as file:
+            block = True
+            while block:
+                block = file.read(block_size)
+                if block:
+                    parser.feed(block)
+                else:
+                    parser.close()
+                for identifier, name, value in target.rejected:
+                    self._report_rejected(identifier, name, value)
+                for identifier in target.deleted:
+                    self.diagnostics.report(logging.INFO, 'record', 'deleted', identifier,
+                                            'Record %s is not imported, because it was deleted.', identifier)
+                if self.incremental:
+                    for identifier in target.withdrawn:
+                        self._seen_records[identifier] = None
+                records = target.records
+                target.records = list()
+                target.rejected = list()
+                target.deleted = list()
+                target.withdrawn = list()
+                yield from records
+
+    def _report_rejected(self, identifier, name, value):
+        if name is None:
+            self.diagnostics.report(logging.INFO, 'record', 'no filter field', identifier,
+                                    'Record %s is not imported, because it has no filter field.', identifier)
+        else:
+            self.diagnostics.report(logging.INFO, name, 'rejected', identifier,
+                                    'Record %s is not imported because of %s %s.', identifier, name, value)
+
     def filter_record(self, record):
         add = False
         for filter in self.import_filter:
@@ -141,22 +1278,37 @@ class TransformFDBRecord(collections.Sequence):
                     add = False
         return add
 
-    def transform_record(self, parent, record, record_name):
+    def transform_record(self, parent, record, record_name, filtered=False):
+        """Transforms record and adds it to parent. With filtered the record already passed the import filter."""
         if record.tag == 'record':
-            if self.filter_record(record):
+            if filtered or self.filter_record(record):
+                if self.incremental and not self._record_changed(record):
+                    return
                 c = ET.SubElement(parent, record_name, xmlns='http://eprints.org/ep2/data/2.0')
+                self._record = c
+                self._slots = dict()
                 fields = list(record.findall(self.base_xml_path))
+                identifier = None
+                # Records do not always carry these fields. Reset them so that no value is carried over from the
+                # previous record.
+                self.current_id = ''
+                self.current_title = ''
+                self.current_type = ''
+                self.current_subtype = ''
+                self.month_day = ''
                 for element in fields:
                     if element.tag == 'title':
                         self.current_title = element.text
                     elif element.tag == 'identifier':
                         self.current_id = element.text
+                        identifier = element.text
                     elif element.tag == 'type':
                         self.current_type = element.text
                     elif element.tag == 'pubtype_weboffice':
                         self.current_subtype = element.text
                     elif element.tag == 'month_day':
                         self.month_day = element.text
+                self._record_ids.append(identifier)
                 for field in self.static_fields:
                     ET.SubElement(c, field).text = self.static_fields[field]
                 for element in fields:
@@ -164,41 +1316,436 @@ class TransformFDBRecord(collections.Sequence):
                         self.functions[element.tag][0](element, c, **self.functions[element.tag][1])
                     else:
                         if element.tag in self.ignore_list:
-                            self.logger.info('This element could not be transformed: %s.', element.tag)
+                            self.diagnostics.report(logging.INFO, element.tag, 'ignored', self.current_id,
+                                                    'This element could not be transformed: %s.', element.tag)
                         else:
-                            self.logger.error('This element could not be transformed: %s.', element.tag)
-
-    def transform_all(self, area_name, record_name, size=1000):
-        def chunk(iterable, n, fillvalue=None):
-            args = [iter(iterable)] * n
-            return zip_longest(*args, fillvalue=fillvalue)
+                            self.diagnostics.report(logging.ERROR, element.tag, 'not transformed', self.current_id,
+                                                    'This element could not be transformed: %s.', element.tag)
+
+    def _record_changed(self, record):
+        """Checks the hash of the record and the transformation config against the state of the last run."""
+        identifier = record.find(self.base_xml_path + 'identifier')
+        if identifier is None:
+            return True
+        digest = hashlib.sha1(self._config_hash + ET.tostring(record)).hexdigest()
+        self._seen_records[identifier.text] = digest
+        return self.record_state.get(identifier.text) != digest
 
+    @property
+    def state_path(self):
+        """The state of the last incremental run is stored next to the data directory."""
+        return os.path.normpath(self.path) + '-state.json'
+
+    def _start_incremental(self):
+        config_description = {
+            'record_type': self.record_type,
+            'functions': {tag: [function.__name__, kwargs] for tag, (function, kwargs) in self.functions.items()},
+            'static_fields': self.static_fields,
+            'import_filter': self.import_filter,
+            'ignore_list': sorted(self.ignore_list)
+        }
+        self._config_hash = json.dumps(config_description, sort_keys=True).encode('utf-8')
+        self.record_state = dict()
+        if os.path.isfile(self.state_path):
+            with open(self.state_path, 'r') as file:
+                self.record_state = json.load(file)
+        self._seen_records = dict()
+
+    def _finish_incremental(self, delta=False):
+        """Stores the hashes of all imported records and lists the records which are no longer imported.
+
+        Records which were rejected by the import filter or deleted are seen without a hash and are always
+        removed. After a delta harvest the records missing from it are unchanged, their hashes are kept. After a
+        full harvest they are removed as well."""
+        seen_records = dict(self.record_state) if delta else dict()
+        seen_records.update(self._seen_records)
+        removed = sorted(identifier for identifier in self.record_state if seen_records.get(identifier) is None)
+        state = {identifier: digest for identifier, digest in seen_records.items() if digest is not None}
+        with open(self.target_path + '{}-removed.txt'.format(self.record_type), 'w') as file:
+            for identifier in removed:
+                file.write(identifier + '\n')
+        with open(self.state_path, 'w') as file:
+            json.dump(state, file)
+        self.logger.info('%s records are new or changed, %s records were removed.',
+                         sum(1 for identifier, digest in state.items()
+                             if self.record_state.get(identifier) != digest), len(removed))
+        self.record_state = state
+        self._seen_records = dict()
+
+    def transform_all(self, area_name, record_name, size=1000, workers=1, incremental=False,
+                      resume=False, compress=False, profile=None, diagnostics=None,
+                      shard_records=None, shard_bytes=None, harvest=False, use_last_update=False, queue_size=None):
+        """Transforms all harvest files into files with at most size records each.
+
+        The harvest files are parsed one record at a time, see iter_records. With workers > 1 the harvest files are spread over a process pool. Each worker writes its
+        chunks to part files which are renamed in harvest file order afterwards. The output is the same in all
+        modes.
+
+        With incremental only records which are new or changed since the last incremental run are written. A
+        record changes if its source or the transformation config changes. The identifiers of records which were
+        imported by the last run but not by this one are written to <record_type>-removed.txt: records which
+        are now rejected by the import filter or deleted in the RDB and, after a full harvest, records missing from
+        it. After a harvest since the last update (use_last_update) the records missing from the harvest are kept
+        as they are.
+
+        After each harvest file the checkpoint is updated. With resume a run which was interrupted continues after
+        the last harvest file which was completely written. Once all files are transformed, the pending watermark
+        of the harvest becomes the last update, provided the harvest completed.
+
+        With compress the output files are written with gzip and get the suffix .xml.gz.
+
+        With shard_records or shard_bytes the output is cut by the transformed records instead of the harvested
+        ones: each harvest file is written to shards <record_type>-<harvest file>-<n>.xml of at most shard_records
+        records or about shard_bytes bytes. Shards are written by the workers directly. In all modes the output
+        files with their record ids, byte size and sha1 are listed in the shard manifest
+        <record_type>-shards.json, so that the import can run in parallel and skip files already imported.
+
+        With profile the calls and durations of every field function, external lookup and I/O stage are measured
+        and a report is written to the file profile. Stages include the functions and lookups they call, e.g. the
+        time of 'stage: transform' contains the time of all 'field: ...' entries.
+
+        The issues found in the records are collected by self.diagnostics and summarised in the log at the end of
+        the run. With diagnostics the summary is written to this file as well.
+
+        With harvest the records are harvested first (see harvest), overlapped with the transformation: each
+        harvest file is transformed as soon as the harvester completed it. With workers at most queue_size harvest
+        files (by default twice the number of workers) are waiting in the process pool. With resume the harvest is
+        skipped if it already completed, otherwise the run starts over.
+
+        The process pool is created for each run and gets the transformation once per worker process, see
+        _init_worker."""
+        self.incremental = incremental
+        self.compress = compress
+        self.shard_records = shard_records
+        self.shard_bytes = shard_bytes
+        sharded = shard_records is not None or shard_bytes is not None
+        if incremental:
+            self._start_incremental()
+
+        self.diagnostics.reset()
+        self.profiler.reset()
+        self.eprint_ids = dict()
+        self.profiler.enabled = profile is not None
+        functions = self.functions
+        if self.profiler.enabled:
+            self.functions = {tag: (ProfiledFunction(self.profiler, 'field: ' + tag, function), kwargs)
+                              for tag, (function, kwargs) in functions.items()}
+
+        if harvest and resume and self.checkpoint.get('harvested', False):
+            self.logger.info('Harvest of %s already completed, resuming with the transformation.', self.record_type)
+            harvest = False
+        items = None
+        if harvest:
+            resume = False
+            items = self._harvest_in_background(use_last_update)
+
+        checkpoint = self.checkpoint
+        with self.profiler.measure('io: manifest'):
+            file_names = self.file_names
+        first_item = 0
         x = 0
-        for item in self:
-            for record in chunk(item, size):
-                eprints = ET.Element(area_name)
-                for r in record:
-                    if r is not None:
-                        self.transform_record(eprints, r, record_name=record_name)
+        if resume:
+            done_files = checkpoint.get('transformed_files', list())
+            if done_files == file_names[:len(done_files)]:
+                first_item = len(done_files)
+                x = checkpoint.get('transformed_chunks', 0)
+                if incremental:
+                    self._seen_records = self._load_partial_state()
+                shards = self._load_partial_shards()
+                self.logger.info('Resuming after %s harvest files and %s chunks.', first_item, x)
+            else:
+                self.logger.warning('The harvest files changed since the checkpoint, starting over.')
+        checkpoint['transformed_files'] = file_names[:first_item]
+        checkpoint['transformed_chunks'] = x
+        if first_item == 0:
+            shards = list()
+            self._save_checkpoint(checkpoint)
+            for path in (self.state_path + '.partial', self.shards_path + '.partial'):
+                if os.path.isfile(path):
+                    os.remove(path)
+
+        def file_done(item, seen, file_shards):
+            checkpoint['transformed_files'].append(self.manifest[item]['file'])
+            checkpoint['transformed_chunks'] = x
+            if incremental:
+                with open(self.state_path + '.partial', 'a') as file:
+                    file.write(json.dumps(seen) + '\n')
+            with open(self.shards_path + '.partial', 'a') as file:
+                file.write(json.dumps(file_shards) + '\n')
+            shards.extend(file_shards)
+            self._save_checkpoint(checkpoint)
+
+        done = sum(entry['records'] for entry in self.manifest[:first_item])
+        if items is None:
+            items = range(first_item, len(self))
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self,)) as executor:
+                for item, (file_shards, seen, side_output_lines, stats, issues, eprint_ids) in self._map_files(
+                        executor, items, queue_size if queue_size is not None else 2 * workers,
+                        area_name, record_name, size):
+                    self.profiler.merge(stats)
+                    self.diagnostics.merge(issues)
+                    self._seen_records.update(seen)
+                    for mcss_id, ids in eprint_ids.items():
+                        known = self.eprint_ids.setdefault(mcss_id, list())
+                        known.extend(eprint_id for eprint_id in ids if eprint_id not in known)
+                    for name, lines in side_output_lines.items():
+                        self.side_outputs[name].extend(lines)
+                    self.flush_side_outputs()
+                    done += self.manifest[item]['records']
+                    self.logger.info('Transformed %s (%s of %s records done).', self.manifest[item]['file'],
+                                     done, self.record_count)
+                    if not sharded:
+                        for shard in file_shards:
+                            path = self._chunk_path(size + x)
+                            os.replace(self.target_path + shard['file'], path)
+                            shard['file'] = os.path.basename(path)
+                            x += 1
+                    file_done(item, seen, file_shards)
+        else:
+            for item in items:
+                self.logger.info('Transforming %s (%s of %s records done).', self.manifest[item]['file'], done,
+                                 self.record_count)
+                done += self.manifest[item]['records']
+                seen_before = self._seen_records
+                self._seen_records = dict()
+                file_shards = self._transform_file(item, area_name, record_name, size, first_number=size + x)
+                x += len(file_shards)
+                file_done(item, self._seen_records, file_shards)
+                seen_before.update(self._seen_records)
+                self._seen_records = seen_before
+        if harvest:
+            checkpoint['harvested'] = True
+            self._save_checkpoint(checkpoint)
+            with self.profiler.measure('io: manifest'):
+                self._write_manifest(self._manifest)
+            self._manifest = None
+        with self.profiler.measure('stage: finish run'):
+            self.finish_run()
+        if incremental:
+            self._finish_incremental(checkpoint.get('delta', False))
+            if os.path.isfile(self.state_path + '.partial'):
+                os.remove(self.state_path + '.partial')
+        with self.profiler.measure('io: manifest'):
+            with open(self.shards_path, 'w') as file:
+                json.dump({'shards': shards}, file)
+            if os.path.isfile(self.shards_path + '.partial'):
+                os.remove(self.shards_path + '.partial')
+
+        # the run is complete, the start of its harvest becomes the new watermark if the harvest completed as well.
+        if checkpoint.get('harvested', False):
+            checkpoint = {'watermark': checkpoint['pending_watermark']}
+        else:
+            checkpoint = {'watermark': checkpoint.get('watermark')}
+        self._save_checkpoint(checkpoint)
+
+        self.functions = functions
+        self.diagnostics.write(diagnostics)
+        if self.profiler.enabled:
+            with open(profile, 'w') as file:
+                file.write(self.profiler.report())
+            self.logger.info('Wrote the profile of the run to %s.', profile)
+            self.profiler.enabled = False
+
+    def _profiled(self, name, function):
+        """Returns function, measured as name if the profiler is enabled."""
+        if self.profiler.enabled:
+            return ProfiledFunction(self.profiler, name, function)
+        return function
+
+    def _load_partial_state(self):
+        """Returns the record hashes of the harvest files transformed before the run was interrupted."""
+        seen = dict()
+        if os.path.isfile(self.state_path + '.partial'):
+            with open(self.state_path + '.partial', 'r') as file:
+                for line in file:
+                    seen.update(json.loads(line))
+        return seen
 
-                with open(self.target_path + '{}-{}.xml'.format(self.record_type, size + x), 'w', encoding='utf-8') as file:
-                    file.write(ET.tostring(eprints, encoding='utf-8').decode('utf-8'))
-                x += 1
+    @property
+    def shards_path(self):
+        return self.target_path + '{}-shards.json'.format(self.record_type)
+
+    def _load_partial_shards(self):
+        """Returns the shard manifest entries of the harvest files transformed before the run was interrupted."""
+        shards = list()
+        if os.path.isfile(self.shards_path + '.partial'):
+            with open(self.shards_path + '.partial', 'r') as file:
+                for line in file:
+                    shards.extend(json.loads(line))
+        return shards
+
+    def _map_files(self, executor, items, max_pending, *args):
+        """Transforms the harvest files of items in the process pool and yields the items with their results in
+        order. At most max_pending harvest files are submitted ahead, so that items can be produced while the
+        workers transform."""
+        pending = collections.deque()
+        for item in items:
+            pending.append((item, executor.submit(_transform_file_task, item, self.manifest[item], *args)))
+            while len(pending) >= max_pending or len(pending) > 0 and pending[0][1].done():
+                item, future = pending.popleft()
+                yield item, future.result()
+        while len(pending) > 0:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+    def _transform_file_in_worker(self, item, entry, area_name, record_name, size):
+        """Transforms the harvest file of the manifest entry into part files. Returns the shard manifest entries of
+        the part files (or of the shards), the record hashes, the lines for the side outputs, the measurements of
+        the profiler, the issues found and the eprints ids of the publications."""
+        # the worker only knows the harvest files it is given.
+        self._manifest[item] = entry
+        self._seen_records = dict()
+        self.eprint_ids = dict()
+        self.profiler.reset()
+        self.diagnostics.reset()
+        shards = self._transform_file(item, area_name, record_name, size)
+        side_output_lines = {name: side_output.take() for name, side_output in self.side_outputs.items()}
+        with self.profiler.measure('stage: finish run'):
+            self.finish_run()
+        return (shards, self._seen_records, side_output_lines, self.profiler.stats, self.diagnostics.issues,
+                self.eprint_ids)
+
+    def _transform_file(self, item, area_name, record_name, size, first_number=None):
+        """Transforms a single harvest file in chunks of size records and returns the shard manifest entries of the
+        files written.
+
+        Chunks are numbered from first_number. Without first_number they are written to part files named after
+        the harvest file index, to be renamed by the caller. With shard_records or shard_bytes the file is written
+        to shards instead, see transform_all.
+        """
+        harvest_file = self.manifest[item]['file']
+        shards = list()
+
+        def next_path():
+            if first_number is None:
+                return self.target_path + '{}-part-{}-{}.xml{}'.format(self.record_type, item, len(shards),
+                                                                      self._output_suffix)
+            return self._chunk_path(first_number + len(shards))
+
+        # Records are kept until the deferred lookups of every batch of write_batch_size records are resolved,
+        # then they are written and dropped.
+        eprints = ET.Element(area_name)
+        writer = None
+        count = 0
+        transform_record = self._profiled('stage: transform', self.transform_record)
+        if self.shard_records is not None or self.shard_bytes is not None:
+            name = os.path.splitext(os.path.relpath(harvest_file, self.path))[0].replace(os.sep, '_')
+            writer = ShardWriter(self.target_path + '{}-{}'.format(self.record_type, name), area_name, harvest_file,
+                                 compress=self.compress, records=self.shard_records, size=self.shard_bytes)
+            for r in self.profiler.iterate('stage: parse', self.iter_records(item)):
+                if r is not None:
+                    transform_record(eprints, r, record_name=record_name, filtered=True)
+                count += 1
+                if count % self.write_batch_size == 0:
+                    self._write_records(eprints, writer)
+            self._write_records(eprints, writer)
+            if first_number is not None:
+                self.flush_side_outputs()
+            with self.profiler.measure('io: write'):
+                return writer.close()
+
+        for r in self.profiler.iterate('stage: parse', self.iter_records(item)):
+            if writer is None:
+                writer = ChunkWriter(next_path(), area_name, compress=self.compress)
+            if r is not None:
+                transform_record(eprints, r, record_name=record_name, filtered=True)
+            count += 1
+            if count % self.write_batch_size == 0 or count == size:
+                self._write_records(eprints, writer)
+            if count == size:
+                shards.append(self._close_chunk(writer, harvest_file))
+                writer = None
+                count = 0
+                if first_number is not None:
+                    self.flush_side_outputs()
+        if writer is not None:
+            self._write_records(eprints, writer)
+            shards.append(self._close_chunk(writer, harvest_file))
+            if first_number is not None:
+                self.flush_side_outputs()
+        return shards
+
+    def _close_chunk(self, writer, harvest_file):
+        """Closes the chunk of writer and returns its shard manifest entry."""
+        with self.profiler.measure('io: write'):
+            writer.close()
+            return writer.entry(harvest_file)
+
+    @property
+    def _output_suffix(self):
+        return '.gz' if self.compress else ''
+
+    def _chunk_path(self, number):
+        return self.target_path + '{}-{}.xml{}'.format(self.record_type, number, self._output_suffix)
+
+    def _write_records(self, eprints, writer):
+        """Resolves the deferred lookups, writes all records of eprints and removes them."""
+        with self.profiler.measure('stage: lookups'):
+            self.finish_chunk()
+        with self.profiler.measure('io: write'):
+            for record, identifier in zip(eprints, self._record_ids):
+                writer.write(record, identifier)
+        eprints.clear()
+        self._record_ids = list()
+
+    def write_side_output(self, name, line):
+        """Adds a line to a side output, if it is enabled for this record type."""
+        if name in self.side_outputs:
+            self.side_outputs[name].write(line)
+
+    def flush_side_outputs(self):
+        with self.profiler.measure('io: side outputs'):
+            for side_output in self.side_outputs.values():
+                side_output.flush()
+
+    def finish_chunk(self):
+        """Runs the lookups which were deferred to be done once per batch of records instead of once per record."""
+        self.resolve_affiliated_publications()
+        self.resolve_contributors()
+        self.resolve_pmids()
+        self.doi_validator.collect()
+
+    def finish_run(self):
+        """Waits for the background work of the run to finish and closes the side outputs."""
+        self.doi_validator.close()
+        for side_output in self.side_outputs.values():
+            side_output.close()
+
+    def _find(self, parent, edoc_tag):
+        """Returns the first child of parent with edoc_tag or None.
+
+        Children of the record which is being transformed are kept in an index, so that they are only searched
+        for once per record."""
+        if parent is not self._record:
+            return parent.find('./' + edoc_tag)
+        if edoc_tag not in self._slots:
+            field = parent.find('./' + edoc_tag)
+            if field is None:
+                return None
+            self._slots[edoc_tag] = field
+        return self._slots[edoc_tag]
+
+    def _container(self, parent, edoc_tag):
+        """Returns the first child of parent with edoc_tag. Creates it if there is none."""
+        field = self._find(parent, edoc_tag)
+        if field is None:
+            field = ET.SubElement(parent, edoc_tag)
+            if parent is self._record:
+                self._slots[edoc_tag] = field
+        return field
 
     def transform_to_list(self, element, parent, edoc_tag):
         """Searches for element with edoc_tag as tag in parent. If not found creates the element. Adds a item to the
         new element."""
-        item = parent.find('./' + edoc_tag)
-        if item is None:
-            item = ET.SubElement(parent, edoc_tag)
+        item = self._container(parent, edoc_tag)
         ET.SubElement(item, 'item').text = element.text.strip()
 
     def transform_to_field(self, element, parent, edoc_tag):
         """Simply translates the field from RDB to edoc."""
         ET.SubElement(parent, edoc_tag).text = element.text.strip()
         if edoc_tag == 'title':
-            with open('titles.txt', 'a') as file:
-                file.write(element.text + '\n')
+            self.write_side_output('titles', element.text)
 
     def transform_name(self, element, parent):
         """Transform a name element. Parent: name-XML-element."""
@@ -210,15 +1757,14 @@ class TransformFDBRecord(collections.Sequence):
             parent.find('./given').text += ' ' + element.text.strip()
         else:
             if element.tag not in self.ignore_list:
-                logging.error('Ignoring the following field in person element: %s', element.tag)
+                self.diagnostics.report(logging.ERROR, element.tag, 'unknown person field', self.current_id,
+                                        'Ignoring the following field in person element: %s', element.tag)
             else:
                 logging.debug('Ignoring the following field in person element: %s', element.tag)
 
     def transform_persons(self, element, parent, edoc_tag, type=''):
         """Transform a unibas contributor."""
-        person = parent.find('./' + edoc_tag)
-        if person is None:
-            person = ET.SubElement(parent, edoc_tag)
+        person = self._container(parent, edoc_tag)
         eprint_item = ET.SubElement(person, 'item')
         name_item = ET.SubElement(eprint_item, 'name')
         for item in element:
@@ -238,9 +1784,7 @@ class TransformFDBRecord(collections.Sequence):
 
     def transform_submitters(self, element, parent, edoc_tag):
         """Same as person, but ignored unibasCHpublicId, DNI and ORCID."""
-        person = parent.find('./' + edoc_tag)
-        if person is None:
-            person = ET.SubElement(parent, edoc_tag)
+        person = self._container(parent, edoc_tag)
         eprint_item = ET.SubElement(person, 'item')
         name_item = ET.SubElement(eprint_item, 'name')
         for item in element:
@@ -251,63 +1795,76 @@ class TransformFDBRecord(collections.Sequence):
                 self.transform_name(item, name_item)
             else:
                 if item.tag not in self.ignore_list:
-                    logging.error('Ignoring field %s for submitters.', item.tag)
+                    self.diagnostics.report(logging.ERROR, item.tag, 'unknown submitter field', self.current_id,
+                                            'Ignoring field %s for submitters.', item.tag)
                 else:
                     logging.debug('Ignoring field %s for submitters.', item.tag)
 
     def transform_html_text(self, element, parent, edoc_tag=''):
         """Transform abstract with special processing from projects."""
-        text = element.text
-        text = html.unescape(text)                  # replace html escaped characters with plain text
-        text = re.sub('<!--.*?-->', '', text)       # remove xml comments (Doc Style Documentation)
-        text = re.sub('<br\\ >', ' ', text)         # replace <br\ > tags with spaces
-        text = re.sub('<[^<]+?>', '', text)         # remove html tags
-        text = re.sub(u'\\x84', '"', text)          # replace double low quotation mark
-        text = re.sub(u'\\xAD', '', text)           # remove soft hyphen
-        text = re.sub(u'\\x96', '-', text)          # replace en-Dash
-        text = re.sub(u'\\x97', '-', text)          # replace em-Dash
-        text = re.sub(u'\\x93', '"', text)          # replace left double quotation mark
-        text = re.sub(u'\\x94', '"', text)          # replace right double quotation mark
-        text = re.sub(u'\\x95', '- ', text)         # replace bullet points
-        text = re.sub(u'\\x91', "'", text)          # replace left single quotation mark
-        text = re.sub(u'\\x92', "'", text)          # replace right single quotation mark
-        text = re.sub(u'\\x0A', '', text)           # remove non-breaking spaces.
-
-        text = re.sub(u'\\u00AC', '', text)         # remove not sign.
-        text = re.sub('\s+', ' ', text)             # replace any collection of whitespace characters with a single space.
-        text = re.sub('Normal .*?bidi;\}', '', text)  # HACK: special stuff that for some reason isn't removed with the HTML Tags.
-        text = text.strip()                         # remove trailing & leading white space
+        text = clean_html_text(element.text)
         if text != '':
             ET.SubElement(parent, edoc_tag).text = text
         else:
-            logging.info('Abstract has been removed from element as it was an empty string after transformation!')
+            self.diagnostics.report(logging.INFO, element.tag, 'empty after cleaning', self.current_id,
+                                    'Abstract has been removed from element as it was an empty string after '
+                                    'transformation!')
 
     def transform_affiliated_publication(self, element, parent, edoc_tag, index, doc_type, url):
         """Transform affiliated publications in projects.
 
-        Uses the given elastic index to translate a mcss id into a eprints id.
+        Uses the given elastic index to translate a mcss id into a eprints id. The lookup is deferred until the
+        end of the chunk, see resolve_affiliated_publications.
 
         When a duplicate is found, all eprints Ids are added and the logging is sent to fodaba@unibas.ch.
         De-duplication has to be resolved manually.
 
         When no match is found the mcss id is ignored. (TODO: send to fodaba@unibas.ch?)
         """
-        field = parent.find('./' + edoc_tag)
-        if field is None:
-            field = ET.SubElement(parent, edoc_tag)
-        es = ElasticIndex(index, doc_type, url=url)
-        query = {'_source': ['eprintid'], 'query': {'term': {'mcss_id': {'value': int(element.text)}}}}
-        result = es.scan_index(query)
-        if len(result) == 1:
-            ET.SubElement(field, 'item').text = str(result[0]['eprintid'])
-        elif len(result) > 1:
-            for e in result:
-                ET.SubElement(field, 'item').text = str(e['eprintid'])
-            logging.error('Found multiple results with mcss_id %s for project %s %s.',
-                          element.text, self.current_id, self.current_title)
-        else:
-            logging.error('Found no eprints ID for the following mcss_id: %s for project %s, %s.',
-                          element.text, self.current_id, self.current_title)
+        field = self._container(parent, edoc_tag)
+        self._pending_publications.append((field, int(element.text), element.text,
+                                           self.current_id, self.current_title, (index, doc_type, url)))
+
+    def resolve_affiliated_publications(self, batch_size=500):
+        """Resolves all collected mcss ids with one terms query per batch and adds the eprints ids.
+
+        Mcss ids found in known_eprint_ids (the publications transformed in the same run) are not looked up. Like
+        the results of Elasticsearch, all eprints ids of such an mcss id are added and several of them are reported.
+        With a snapshot the eprints ids are taken from the snapshot instead of Elasticsearch."""
+        pending = self._pending_publications
+        self._pending_publications = list()
+
+        eprint_ids = dict()
+        for source in {p[5] for p in pending}:
+            mcss_ids = sorted({p[1] for p in pending if p[5] == source and p[1] not in self.known_eprint_ids})
+            if self.snapshot is not None:
+                with self.profiler.measure('lookup: snapshot'):
+                    for mcss_id, result in self.snapshot.eprint_ids(source[0], mcss_ids).items():
+                        eprint_ids[(source, mcss_id)] = result
+                continue
+            es = self._elastic(*source)
+            for i in range(0, len(mcss_ids), batch_size):
+                query = {'_source': ['eprintid', 'mcss_id'], 'query': {'terms': {'mcss_id': mcss_ids[i:i + batch_size]}}}
+                with self.profiler.measure('lookup: elastic ' + source[0]):
+                    results = list(es.scan_index(query))
+                for result in results:
+                    eprint_ids.setdefault((source, int(result['mcss_id'])), list()).append(result['eprintid'])
+
+        for field, mcss_id, text, current_id, current_title, source in pending:
+            if mcss_id in self.known_eprint_ids:
+                result = self.known_eprint_ids[mcss_id]
+            else:
+                result = eprint_ids.get((source, mcss_id), list())
+            for eprint_id in result:
+                ET.SubElement(field, 'item').text = str(eprint_id)
+            if len(result) > 1:
+                self.diagnostics.report(logging.ERROR, 'affilatedpublication', 'several eprints', current_id,
+                                        'Found multiple results with mcss_id %s for project %s %s.',
+                                        text, current_id, current_title)
+            elif len(result) == 0:
+                self.diagnostics.report(logging.ERROR, 'affilatedpublication', 'no eprint', current_id,
+                                        'Found no eprints ID for the following mcss_id: %s for project %s, %s.',
+                                        text, current_id, current_title)
 
     def transform_dni_to_contributor(self, element, parent, edoc_tag,
                                      index='', doc_type='', url='',
@@ -318,59 +1875,148 @@ class TransformFDBRecord(collections.Sequence):
         contributor is copied over.
 
         If the edoc dataservice turns up empty the RDB Persons Database is searched. If found all data is copied over.
+
+        The lookup is deferred until the end of the chunk, see resolve_contributors. A placeholder keeps the
+        position of the contributor field in the record.
         """
         if element.text is not None:
-            es = ElasticIndex(index, doc_type, url=url)
+            placeholder = ET.SubElement(parent, '_contributor_placeholder')
+            self._pending_contributors.append((placeholder, parent, element.text, element.tag, self.current_id,
+                                               (index, doc_type, url, fdb_index, fdb_doc_type, fdb_url)))
+        else:
+            self.diagnostics.report(logging.ERROR, element.tag, 'empty dni', self.current_id,
+                                    'A DNI in element %s is None.', self.current_id)
+
+    def resolve_contributors(self, batch_size=500):
+        """Resolves all collected DNIs and replaces the placeholders with the contributors.
+
+        The DNIs are looked up in the cache first, keyed by the indices and the DNI. The remaining ones are resolved
+        with one terms query per batch against edoc dataservice and then against the RDB persons database for those
+        not found in edoc. With a snapshot all DNIs are resolved with the snapshot and the cache is not used.
+        """
+        pending = self._pending_contributors
+        self._pending_contributors = list()
+
+        answers = dict()
+        for source in {p[5] for p in pending}:
+            dnis = sorted({p[2] for p in pending if p[5] == source})
+            if self.snapshot is not None:
+                with self.profiler.measure('lookup: snapshot'):
+                    answers[source] = self.snapshot.contributors(source[0], source[3], dnis)
+                continue
+            # the answers depend on the indices, so they are cached per source.
+            keys = {json.dumps(list(source) + [dni]): dni for dni in dnis}
+            answers[source] = {keys[key]: answer for key, answer in self.cache.get_many('contributor', keys).items()}
+            missing = [dni for dni in dnis if dni not in answers[source]]
+            if len(missing) > 0:
+                resolved = self._search_contributors(missing, *source, batch_size=batch_size)
+                self.cache.set_many('contributor', {json.dumps(list(source) + [dni]): answer
+                                                    for dni, answer in resolved.items()})
+                answers[source].update(resolved)
+
+        contributors = dict()
+        for placeholder, parent, dni, tag, record_id, source in pending:
+            answer = answers[source][dni]
+            if answer['source'] == 'fdb' and len(answer['persons']) == 0:
+                self.diagnostics.report(logging.ERROR, tag, 'unknown dni', record_id,
+                                        'Could not find an author with dni %s.', dni)
+            elif answer['source'] == 'fdb' and len(answer['persons']) > 1:
+                # Should never happen...
+                self.diagnostics.report(logging.CRITICAL, tag, 'several persons with dni', record_id,
+                                        'Found several persons with DNI %s in RDB.', dni)
+
+            if answer['source'] == 'edoc' and len(answer['contributors']) > 0 or \
+                    answer['source'] == 'fdb' and len(answer['persons']) == 1:
+                contributor = contributors.get(parent)
+                if contributor is None:
+                    contributor = parent.find('./contributor')
+                if contributor is None:
+                    placeholder.tag = 'contributor'
+                    contributor = placeholder
+                    contributors[parent] = contributor
+                else:
+                    parent.remove(placeholder)
+                if answer['source'] == 'edoc':
+                    for contrib in answer['contributors']:
+                        self._add_edoc_contributor(contributor, contrib)
+                else:
+                    self._add_fdb_contributor(contributor, answer['persons'][0])
+            else:
+                parent.remove(placeholder)
+
+    def _search_contributors(self, dnis, index, doc_type, url, fdb_index, fdb_doc_type, fdb_url, batch_size=500):
+        """Searches the DNIs in edoc dataservice and the rest in the RDB persons database.
+
+        Returns for each DNI either the matching contributors of the first edoc document with this DNI or all
+        persons with this DNI in RDB."""
+        answers = dict()
+        es = self._elastic(index, doc_type, url)
+        for i in range(0, len(dnis), batch_size):
+            batch = {value: [dni for dni in dnis[i:i + batch_size] if int(dni) == value]
+                     for value in {int(dni) for dni in dnis[i:i + batch_size]}}
             query = {
                 '_source': ['contributors'],
-                'query': {'term': {'contributors.dni.keyword': {'value': int(element.text)}}}}
-            results = es.scan_index(query)
-            if len(results) > 0:
+                'query': {'terms': {'contributors.dni.keyword': sorted(batch)}}}
+            with self.profiler.measure('lookup: elastic ' + index):
+                results = list(es.scan_index(query))
+            for result in results:
                 # returns all contributors. Only add the one with the right DNI.
-                for contrib in results[0]['contributors']:
-                    if 'dni' in contrib and str(contrib['dni']) == element.text:
-                        contributor = parent.find('./contributor')
-                        if contributor is None:
-                            contributor = ET.SubElement(parent, 'contributor')
-                        item = ET.SubElement(contributor, 'item')
-                        ET.SubElement(item, 'dni').text = str(contrib['dni']).strip()
-                        name = ET.SubElement(item, 'name')
-                        ET.SubElement(name, 'given').text = str(contrib['name']['given']).strip()
-                        ET.SubElement(name, 'family').text = str(contrib['name']['family']).strip()
-                        if 'id' in contrib:
-                            ET.SubElement(item, 'id').text = str(contrib['id']).strip()
-                        if 'orcid' in contrib:
-                            ET.SubElement(item, 'orcid').text = str(contrib['orcid']).strip()
-                        if 'unibasChPublicId' in contrib:
-                            ET.SubElement(item, 'unibasChPublicId').text = str(contrib['unibasChPublicId']).strip()
-            else:  # len(results) == 0
-                # try to search it in RDB persons database.
-                fdb = ElasticIndex(fdb_index, fdb_doc_type, url=fdb_url)
-                query = {'query': {'term': {'dni.keyword': {'value': int(element.text)}}}}
-                fdb_results = fdb.scan_index(query)
-                if len(fdb_results) == 0:
-                    self.logger.error('Could not find an author with dni %s.', element.text)
-                elif len(fdb_results) == 1:
-                    # in case of a single find => add the contributor to the list.
-                    contributor = parent.find('./contributor')
-                    if contributor is None:
-                        contributor = ET.SubElement(parent, 'contributor')
-                    item = ET.SubElement(contributor, 'item')
-                    r = fdb_results[0]
-                    ET.SubElement(item, 'id').text = r['email'].strip()
-                    if 'unibasCHpublicId' in r:
-                        ET.SubElement(item, 'unibasChPublicId').text = r['unibasCHpublicId']
-                    if 'orcid' in r:
-                        ET.SubElement(item, 'orcid').text = r['orcid'].strip()
-                    ET.SubElement(item, 'dni').text = str(r['dni']).strip()
-                    name = ET.SubElement(item, 'name')
-                    ET.SubElement(name, 'given').text = r['firstname'].strip()
-                    ET.SubElement(name, 'family').text = r['lastname'].strip()
-                else:
-                    # Should never happen...
-                    self.logger.critical('Found several persons with DNI %s in RDB.', element.text)
-        else:
-            self.logger.error('A DNI in element %s is None.', self.current_id)
+                matched = set()
+                for contrib in result['contributors']:
+                    if 'dni' in contrib:
+                        try:
+                            matched.add(int(contrib['dni']))
+                        except ValueError:
+                            pass
+                for value in matched & set(batch):
+                    for dni in batch[value]:
+                        if dni not in answers:
+                            answers[dni] = {'source': 'edoc',
+                                            'contributors': [contrib for contrib in result['contributors']
+                                                             if 'dni' in contrib and str(contrib['dni']) == dni]}
+
+        # try to search the rest in RDB persons database.
+        missing = [dni for dni in dnis if dni not in answers]
+        for dni in missing:
+            answers[dni] = {'source': 'fdb', 'persons': list()}
+        fdb = self._elastic(fdb_index, fdb_doc_type, fdb_url)
+        for i in range(0, len(missing), batch_size):
+            batch = missing[i:i + batch_size]
+            query = {'query': {'terms': {'dni.keyword': sorted({int(dni) for dni in batch})}}}
+            with self.profiler.measure('lookup: elastic ' + fdb_index):
+                results = list(fdb.scan_index(query))
+            for result in results:
+                for dni in batch:
+                    if int(dni) == int(result['dni']):
+                        answers[dni]['persons'].append(result)
+        return answers
+
+    @staticmethod
+    def _add_edoc_contributor(contributor, contrib):
+        item = ET.SubElement(contributor, 'item')
+        ET.SubElement(item, 'dni').text = str(contrib['dni']).strip()
+        name = ET.SubElement(item, 'name')
+        ET.SubElement(name, 'given').text = str(contrib['name']['given']).strip()
+        ET.SubElement(name, 'family').text = str(contrib['name']['family']).strip()
+        if 'id' in contrib:
+            ET.SubElement(item, 'id').text = str(contrib['id']).strip()
+        if 'orcid' in contrib:
+            ET.SubElement(item, 'orcid').text = str(contrib['orcid']).strip()
+        if 'unibasChPublicId' in contrib:
+            ET.SubElement(item, 'unibasChPublicId').text = str(contrib['unibasChPublicId']).strip()
+
+    @staticmethod
+    def _add_fdb_contributor(contributor, r):
+        item = ET.SubElement(contributor, 'item')
+        ET.SubElement(item, 'id').text = r['email'].strip()
+        if 'unibasCHpublicId' in r:
+            ET.SubElement(item, 'unibasChPublicId').text = r['unibasCHpublicId']
+        if 'orcid' in r:
+            ET.SubElement(item, 'orcid').text = r['orcid'].strip()
+        ET.SubElement(item, 'dni').text = str(r['dni']).strip()
+        name = ET.SubElement(item, 'name')
+        ET.SubElement(name, 'given').text = r['firstname'].strip()
+        ET.SubElement(name, 'family').text = r['lastname'].strip()
 
     def transform_start_date(self, element, parent, edoc_tag_start_date, edoc_tag_simple_date):
         """Transform achievement startdate.
@@ -399,7 +2045,8 @@ class TransformFDBRecord(collections.Sequence):
         elif element.text == 'Project: Project funded by own resources':
             ET.SubElement(parent, edoc_tag).text = 'own_resource'
         else:
-            self.logger.critical('Unknown project type: %s.', element.text)
+            self.diagnostics.report(logging.CRITICAL, element.tag, 'unknown project type', self.current_id,
+                                    'Unknown project type: %s.', element.text)
 
     @staticmethod
     def transform_project_status(element, parent, edoc_tag):
@@ -407,19 +2054,17 @@ class TransformFDBRecord(collections.Sequence):
         status = {'Completed': 'complete', 'Active': 'ongoing'}
         ET.SubElement(parent, edoc_tag).text = status[element.text]
 
-    @staticmethod
-    def transform_financed_by(element, parent, edoc_tag):
+    def transform_financed_by(self, element, parent, edoc_tag):
         """Transform project financed_by."""
-        field = parent.find('./' + edoc_tag)
-        if field is None:
-            field = ET.SubElement(parent, edoc_tag)
+        field = self._container(parent, edoc_tag)
         item = ET.SubElement(field, 'item')
         ET.SubElement(item, 'name').text = element.text.strip()
 
     def transform_web_appearance(self, element, parent, edoc_tag):
         """Add hide_on_weblist if easyWeb_appearance = "Do not show on easyWeb-Pages"."""
         if element.text == 'Do not show on easyWeb-Pages':
-            logging.info('%s is hidden on web page.', self.current_id)
+            self.diagnostics.report(logging.INFO, element.tag, 'hidden on web page', self.current_id,
+                                    '%s is hidden on web page.', self.current_id)
             ET.SubElement(parent, edoc_tag).text = 'TRUE'
         else:
             ET.SubElement(parent, edoc_tag).text = 'FALSE'
@@ -428,7 +2073,7 @@ class TransformFDBRecord(collections.Sequence):
         """Transforms the title of a publication.
 
         Removes special signs, html stuff & a dot at the end if this is a pub-med import."""
-        if parent.find('./pubmedid'):
+        if self._find(parent, 'pubmedid'):
             element.text = element.text.strip('.')
         self.transform_html_text(element, parent, edoc_tag)
 
@@ -479,7 +2124,14 @@ class TransformFDBRecord(collections.Sequence):
 
     def _create_note_from_type(self, element, parent):
         """Generate the note from the RDB type."""
-        value = re.sub('Publication: ', 'Publication type according to Uni Basel Research Database: ', element.text)
+        if element.text not in self.type_notes:
+            self.type_notes[element.text] = self._note_from_type(element.text)
+        element.text = self.type_notes[element.text]
+        self.append_to_field(element, parent, 'note', separator=' -- ')
+
+    @staticmethod
+    def _note_from_type(value):
+        value = re.sub('Publication: ', 'Publication type according to Uni Basel Research Database: ', value)
 
         value = re.sub('Authored Book \(Verfasser eines eigenst.ndigen Buches\)', 'Authored book', value)
         value = re.sub('Book Item \(Buchkap\., Lexikonartikel, jur\. Kommentierung, Beiträge in Sammelbänden etc\.\)',
@@ -494,50 +2146,47 @@ class TransformFDBRecord(collections.Sequence):
         value = re.sub('NewsItemEmission \(Radio - Fernsehbeitr.ge\)', 'News item emission', value)
         value = re.sub('NewsItemPrint \(Artikel in einer Tages, Wochen- oder Monatszeitschrift\)', 'News item print', value)
         value = re.sub('Other Publications \(Forschungsberichte o\. ä\.\)', 'Other publications', value)
-        element.text = value
-        self.append_to_field(element, parent, 'note', separator=' -- ')
+        return value
 
     def transform_pubtype_weboffice(self, element, parent, edoc_tag):
         """Transforms the pubtype weboffice to a subtype where possible.
         """
-
-        subtypes = {
-            'Review':'review',
-            'Rezension': 'book_review',
-            'Urteilsanmerkung': 'annotation',
-            'Aufsatz/Beitrag in Sammelband': 'chapter',
-            'Lexikonartikel': 'encyclopedia',
-            'Jur. Kommentierung': 'commentary',
-            'Übersetzung': 'contribution'
-        }
-
-        if element.text in subtypes:
-            text = subtypes[element.text]
-        elif element.text == 'Edition' and re.search('Editied Book', self.current_type):
-            text = 'contribution'
-        elif re.search('JournalArticle', self.current_type):
-            text = 'research'
-        elif re.search('JournalItem', self.current_type):
-            text = 'contribution'
-        elif re.search('Authored Book', self.current_type):
-            text = 'authored'
-        elif re.search('Edited Book', self.current_type):
-            text = 'edited'
-        elif self.publication_types[self.current_type] == 'book_section':
-            text = 'contribution'
-        elif re.search('ConferencePaper', self.current_type):
-            text = 'paper'
-        else:
-            text = ''
-            self.logger.error('Could not determine subtype of %s with type %s and subtype %s.', self.current_id,
-                              self.current_type, self.current_subtype)
+        subtype = element.text if element.text in self.publication_subtypes or element.text == 'Edition' else None
+        key = (subtype, self.current_type)
+        if key not in self.subtypes_by_type:
+            self.subtypes_by_type[key] = self._subtype_from_type(*key)
+        text = self.subtypes_by_type[key]
+        if text == '':
+            self.diagnostics.report(logging.ERROR, element.tag, 'unknown subtype', self.current_id,
+                                    'Could not determine subtype of %s with type %s and subtype %s.', self.current_id,
+                                    self.current_type, self.current_subtype)
 
         pub_type = self._create_publication_type(parent)
 
         ET.SubElement(parent, pub_type + edoc_tag).text = text
 
-    @staticmethod
-    def transform_creators(element, parent):
+    def _subtype_from_type(self, subtype, pub_type):
+        """Returns the edoc subtype for a pubtype weboffice and publication type or an empty string."""
+        if subtype in self.publication_subtypes:
+            return self.publication_subtypes[subtype]
+        elif subtype == 'Edition' and re.search('Editied Book', pub_type):
+            return 'contribution'
+        elif re.search('JournalArticle', pub_type):
+            return 'research'
+        elif re.search('JournalItem', pub_type):
+            return 'contribution'
+        elif re.search('Authored Book', pub_type):
+            return 'authored'
+        elif re.search('Edited Book', pub_type):
+            return 'edited'
+        elif self.publication_types[pub_type] == 'book_section':
+            return 'contribution'
+        elif re.search('ConferencePaper', pub_type):
+            return 'paper'
+        else:
+            return ''
+
+    def transform_creators(self, element, parent):
         """Transform the creators list into given / family name pairs."""
         # TODO: Add clean up routines.
         creators = ET.SubElement(parent, 'creator')
@@ -547,7 +2196,8 @@ class TransformFDBRecord(collections.Sequence):
             try:
                 family, given = name.split(',')
             except ValueError:
-                logging.error('Could not split the following name: %s.', name)
+                self.diagnostics.report(logging.ERROR, element.tag, 'unsplittable name', self.current_id,
+                                        'Could not split the following name: %s.', name)
             else:
                 item = ET.SubElement(creators, 'item')
                 ET.SubElement(item, 'family').text = family.strip()
@@ -565,53 +2215,82 @@ class TransformFDBRecord(collections.Sequence):
         # TODO: implement check if id_number is valid
 
         if type_tag == 'doi':
-            try:
-                response = requests.get('https://doi.org/api/handles/' + text)
-            except Exception as error:
-                self.logger.error('Could not access doi resolver, because %s.', str(error))
-            else:
-                response_code = json.loads(response.text)['responseCode']
-                if response_code == 1:
-                    self.logger.info('DOI Found.')
-                elif response_code == 2:
-                    self.logger.error('Something unexpected went wrong during handle resolution. '
-                                      '(HTTP 500 Internal Server Error).')
-                elif response_code == 100:
-                    self.logger.error('Handle %s not found for record %s.', element.text, self.current_id)
-                elif response_code == 200:
-                    self.logger.warning('Values Not Found. The handle %s exists but has no values (or no values '
-                                        'according to the types and indices specified). (HTTP 200 OK) for record %s.',
-                                        element.text, self.current_id)
+            self.doi_validator.submit(text, element.text, self.current_id)
 
-        if type_tag == 'pmid':
-            try:
-                response = requests.get('https://www.ncbi.nlm.nih.gov/pmc/utils/idconv/v1.0/?ids=' + text +
-                                        '&format=json')
-            except Exception as error:
-                self.logger.error('Could not access PubMed Converter, because %s.', str(error))
-            else:
-                response = json.loads(response.text)
-                if response['status'] == 'ok':
-                    record = response['records'][0]
-                    if 'status' in record and record['status'] == 'error':
-                        self.logger.error(record['errmsg'])
-                    elif 'doi' in record:
-                        self.logger.info('Found DOI')
-                        # TODO: find a good way to append this data if not already there.
-
-        id_number = parent.find('./id_number')
-        if id_number is None:
-            id_number = ET.SubElement(parent, 'id_number')
+        id_number = self._container(parent, 'id_number')
         item = ET.SubElement(id_number, 'item')
         ET.SubElement(item, 'type').text = type_tag
         ET.SubElement(item, 'id').text = text
 
-    @staticmethod
-    def append_to_field(element, parent, edoc_tag, prefix='', suffix='', separator=' '):
+        if type_tag == 'pmid':
+            self._pending_pmids.append((id_number, text, self.current_id))
+
+    def resolve_pmids(self, batch_size=200):
+        """Resolves the collected PubMed ids with the PMC id converter, up to batch_size ids per request.
+
+        If a DOI is found and the record has no DOI yet, it is added as an additional id number.
+
+        The answers of the converter are cached. In offline mode only cached answers are used."""
+        pending = self._pending_pmids
+        self._pending_pmids = list()
+
+        # issues are reported once per PubMed id, for the first record with it.
+        record_ids = dict()
+        for _, pmid, record_id in pending:
+            record_ids.setdefault(pmid, record_id)
+        pmids = sorted(record_ids)
+        records = self.cache.get_many('pmid', pmids)
+        missing = [pmid for pmid in pmids if pmid not in records]
+        if self.offline:
+            for pmid in missing:
+                self.diagnostics.report(logging.INFO, 'pubmedid', 'not resolved offline', record_ids[pmid],
+                                        'PubMed id %s is not cached and was not resolved in offline mode.', pmid)
+        else:
+            for i in range(0, len(missing), batch_size):
+                with self.profiler.measure('lookup: pmc id converter'):
+                    batch = self._convert_pmids(missing[i:i + batch_size])
+                converted = {str(record.get('pmid', record.get('requested-id'))): record for record in batch}
+                self.cache.set_many('pmid', converted)
+                records.update(converted)
+
+        dois = dict()
+        for pmid in pmids:
+            if pmid in records:
+                record = records[pmid]
+                if 'status' in record and record['status'] == 'error':
+                    self.diagnostics.report(logging.ERROR, 'pubmedid', 'not converted', record_ids[pmid],
+                                            record['errmsg'])
+                elif 'doi' in record:
+                    if self.diagnostics.verbose:
+                        self.logger.info('Found DOI')
+                    dois[pmid] = record['doi']
+
+        for id_number, pmid, _ in pending:
+            if pmid in dois:
+                if not any(item.findtext('./type') == 'doi' for item in id_number):
+                    item = ET.SubElement(id_number, 'item')
+                    ET.SubElement(item, 'type').text = 'doi'
+                    ET.SubElement(item, 'id').text = dois[pmid]
+
+    def _convert_pmids(self, pmids):
+        """Returns the records of the PMC id converter for the given PubMed ids."""
+        if self._http_session is None:
+            self._http_session = requests.Session()
+        try:
+            response = self._http_session.get('https://www.ncbi.nlm.nih.gov/pmc/utils/idconv/v1.0/',
+                                              params={'ids': ','.join(pmids), 'format': 'json'},
+                                              timeout=config.getfloat('pubmed', 'timeout', fallback=30))
+        except Exception as error:
+            self.logger.error('Could not access PubMed Converter, because %s.', str(error))
+            return list()
+        response = json.loads(response.text)
+        if response['status'] == 'ok':
+            return response['records']
+        return list()
+
+    def append_to_field(self, element, parent, edoc_tag, prefix='', suffix='', separator=' '):
         """Append text to a field with a optional prefix/suffix value. Default separator is a single space."""
-        field = parent.find('./' + edoc_tag)
-        if field is None:
-            field = ET.SubElement(parent, edoc_tag)
+        field = self._container(parent, edoc_tag)
         previous_text = field.text
         if previous_text is not None:
             field.text = previous_text + separator + prefix + element.text + suffix
@@ -627,9 +2306,18 @@ class TransformFDBRecord(collections.Sequence):
         else:
             self.append_to_field(element, parent, 'note', prefix='Edition: ', separator=' -- ')
 
+    def index_eprint_id(self, element, parent):
+        """Adds the eprints id of the edoc url to the eprints ids of the mcss id in eprint_ids, to resolve
+        affiliated publications of projects transformed in the same run."""
+        match = re.search(r'/(\d+)/?$', (element.text or '').strip())
+        if match is not None and self.current_id.isdigit():
+            ids = self.eprint_ids.setdefault(int(self.current_id), list())
+            if int(match.group(1)) not in ids:
+                ids.append(int(match.group(1)))
+
     def log_fulltext_url(self, element, parent):
         """Prints the the fulltext urls for import with fulltext import script."""
-        self.full_text_logger.info('%s|%s', self.current_id, element.text)
+        self.write_side_output('fulltext', '{}|{}'.format(self.current_id, element.text))
 
     def transform_date(self, element, parent, edoc_tag):
         """Tansform publication date from two elements. dc:date + fdb:month_day."""
@@ -649,34 +2337,62 @@ class TransformFDBRecord(collections.Sequence):
 
     def transform_related_url(self, element, parent, edoc_tag, url_type):
         """Transforms a related url."""
-        field = parent.find('./' + edoc_tag)
-        if field is None:
-            field = ET.SubElement(parent, edoc_tag)
+        field = self._container(parent, edoc_tag)
         item = ET.SubElement(field, 'item')
         ET.SubElement(item, 'type').text = url_type
 
         if not re.search('^http[s]?://', element.text):
-            self.logger.warning('URL is missing protocol-prefix %s for publication %s.', element.text, self.current_id)
+            self.diagnostics.report(logging.WARNING, element.tag, 'url without protocol', self.current_id,
+                                    'URL is missing protocol-prefix %s for publication %s.', element.text,
+                                    self.current_id)
 
         ET.SubElement(item, 'url').text = element.text
 
     def transform_mcssorgid(self, element, parent, edoc_tag):
         """Transform mcss org id to divisions and add department."""
-        if parent.find('./department') is None:
+        if self._find(parent, 'department') is None:
             try:
-                ET.SubElement(parent, 'department').text = self.departments[element.text]
+                self._container(parent, 'department').text = self.organisations.department(element.text)
             except KeyError:
-                self.logger.error('Could not match mcssorgid %s for in publication %s.', element.text, self.current_id)
+                self.diagnostics.report(logging.ERROR, element.tag, 'unknown organisation', self.current_id,
+                                        'Could not match mcssorgid %s for in publication %s.', element.text,
+                                        self.current_id)
         self.transform_to_list(element, parent, edoc_tag)
 
 
-
-
-
-
-
-
-
-
-
-
+def add_run_arguments(parser):
+    """Adds the options of a transformation run to the argparse parser, see run_options."""
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used for the transformation.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only write records which changed since the last incremental run.')
+    parser.add_argument('--harvest', action='store_true',
+                        help='Harvest the records from the RDB and transform each harvest file as soon as it is written.')
+    parser.add_argument('--since-last-update', action='store_true',
+                        help='With --harvest only harvest the records changed since the last completed run.')
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted run from its checkpoint.')
+    parser.add_argument('--gzip', action='store_true', help='Compress the output files with gzip.')
+    parser.add_argument('--shard-records', type=int,
+                        help='Cut the output into files of at most this many transformed records per harvest file.')
+    parser.add_argument('--shard-bytes', type=int,
+                        help='Cut the output into files of about this many bytes per harvest file.')
+    parser.add_argument('--profile', nargs='?', const=True,
+                        help='Measure the stages of the run and write a report to this file, by default to '
+                             '<type>_profile.txt.')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Log every issue of every record instead of a summary per kind of issue.')
+    parser.add_argument('--snapshot', help='Resolve affiliated publications and DNIs with this snapshot of edoc '
+                                           'instead of Elasticsearch, see snapshot.py.')
+
+
+def run_options(tf, args, name):
+    """Applies the options of add_run_arguments to the transformation tf and returns the keyword arguments of
+    transform_all for the record type name."""
+    if args.verbose:
+        tf.diagnostics.verbose = True
+    if args.snapshot is not None:
+        tf.snapshot = EdocSnapshot(args.snapshot)
+    return {'workers': args.workers, 'incremental': args.incremental, 'resume': args.resume, 'compress': args.gzip,
+            'profile': '{}_profile.txt'.format(name) if args.profile is True else args.profile,
+            'diagnostics': '{}_diagnostics.json'.format(name),
+            'shard_records': args.shard_records, 'shard_bytes': args.shard_bytes,
+            'harvest': args.harvest, 'use_last_update': args.since_last_update}